@@ -1,19 +1,36 @@
 #!/usr/bin/env python
 # encoding: utf-8
+# annotations stay unevaluated, so aiohttp is only imported once a download needs it
+from __future__ import annotations
+
 import argparse
 import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import functools
+import hashlib
+import inspect
+import itertools
+import json
 import logging
+import math
 import os
+import random
+import re
+import socket
 import sys
-from typing import Optional, List, Union, Generator, Tuple
+import threading
+import time
+import urllib.parse
+import weakref
+from typing import Optional, List, Union, Tuple, Callable, Awaitable, Iterable, Deque, Dict, \
+    NamedTuple, AsyncIterator, TYPE_CHECKING
 
-import aiohttp
-import requests
+if TYPE_CHECKING:
+    import aiohttp
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s %(levelname)s %(message)s',
-)
 # __version__ = 0.3
 Index = Start = Stop = int
 Url = FilePath = str
@@ -21,59 +38,1686 @@ AssetInfo = LectureInfo = dict
 StreamInfoList = SupplementaryAssetInfoList = LectureInfoList = List[dict]
 
 CHUNKSIZE = 1024 * 512
-PART_NUMBER = 10
-MY_COURSES_URL = "https://www.udemy.com/api-2.0/users/me/subscribed-courses?fields[course]=id,url,published_title&ordering=-access_time&page=1&page_size=10000"
-COURSE_URL = 'https://www.udemy.com/api-2.0/courses/{course_id}/cached-subscriber-curriculum-items?fields[asset]=results,external_url,time_estimation,download_urls,slide_urls,filename,asset_type,captions,stream_urls,body&fields[chapter]=object_index,title,sort_order&fields[lecture]=id,title,object_index,asset,supplementary_assets,view_html&page_size=10000'
+PLAN_BANDWIDTH = 10.0
+# bytes read at once while a rate limit is set, small reads keep the traffic smooth
+SHAPED_READ_SIZE = 1024 * 64
+# a bucket holds at most this many seconds of traffic
+BURST_SECONDS = 0.1
+RATE_FILE_POLL_INTERVAL = 1
+MIN_CHUNKSIZE = 1024 * 128
+MAX_CHUNKSIZE = 1024 * 1024 * 16
+TARGET_CHUNK_SECONDS = 2
+LATENCY_FACTOR = 3
+LATENCY_SLACK = 0.05
+WINDOW_SIZE = 10
+MAX_CONNECTIONS = 64
+MAX_API_CONNECTIONS = 8
+MAX_CONNECTIONS_PER_HOST = 0
+KEEPALIVE_TIMEOUT = 30
+DNS_CACHE_TTL = 300
+SOCKET_BUFFER_SIZE = 0
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 60
+MAX_STREAMS = 8
+MAX_CHUNKS = 32
+MAX_SMALL_ASSETS = 8
+RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30
+RETRY_BUDGET = 100
+# retry tokens earned back by each successful call
+RETRY_BUDGET_REFILL = 0.1
+RETRYABLE_STATUSES = frozenset({408, 425, 429, 500, 502, 503, 504})
+# answers of the video CDN to a signed URL past its expiry
+EXPIRED_URL_STATUSES = frozenset({403, 410})
+# expiries in a row a call retries right away on refreshed URLs before they count as failures
+URL_REFRESHES = 3
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 10
+WRITER_THREADS = 2
+# bytes handed to the writer threads and not written yet before network reads pause
+WRITE_QUEUE_SIZE = 1024 * 1024 * 64
+# adjacent reads of a chunk are gathered into writes of this many bytes
+WRITE_COALESCE_SIZE = 1024 * 1024
+# buffers in one vectored write, the IOV_MAX of Linux
+IOV_MAX = 1024
+# none: leave flushing to the OS, range: sync every chunk before the journal records it,
+# file: sync every video before it is renamed into place
+FSYNC_POLICIES = ('none', 'range', 'file')
+METRICS_HOST = '127.0.0.1'
+# upper bounds of the histogram buckets, in seconds
+HISTOGRAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+JOURNAL_FILENAME = '.async-udemy-dl.sqlite'
+CURRICULUM_PAGE_SIZE = 100
+CURRICULUM_CACHE_TTL = 300
+SUBSCRIPTION_INDEX_FILENAME = 'subscribed-courses.json'
+CACHE_DIRECTORY = os.path.join(os.environ.get('XDG_CACHE_HOME', '~/.cache'), 'async-udemy-dl')
+SUBSCRIPTION_PAGE_SIZE = 100
+SUBSCRIPTION_INDEX_TTL = 24 * 60 * 60
+# another host serving the same API, like the stand-in server of the benchmarks
+UDEMY_URL = os.environ.get('ASYNC_UDEMY_DL_URL', 'https://www.udemy.com').rstrip('/')
+MY_COURSES_URL = UDEMY_URL + "/api-2.0/users/me/subscribed-courses?fields[course]=id,url,published_title&ordering=-access_time&page=1&page_size=" + str(SUBSCRIPTION_PAGE_SIZE)
+COURSE_URL = UDEMY_URL + '/api-2.0/courses/{course_id}/cached-subscriber-curriculum-items?fields[asset]=results,external_url,time_estimation,filename,asset_type,captions,stream_urls&fields[chapter]=object_index,title,sort_order&fields[lecture]=id,title,object_index,asset,supplementary_assets&page_size=' + str(CURRICULUM_PAGE_SIZE)
+LECTURE_URL = UDEMY_URL + '/api-2.0/users/me/subscribed-courses/{course_id}/lectures/{lecture_id}?fields[lecture]=asset&fields[asset]=stream_urls'
+# article bodies are left out of the curriculum and fetched when the article is written
+ARTICLE_URL = UDEMY_URL + '/api-2.0/users/me/subscribed-courses/{course_id}/lectures/{lecture_id}?fields[lecture]=asset&fields[asset]=body'
 HEADERS = {
-    'Host': 'www.udemy.com',
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:66.0) Gecko/20100101 Firefox/66.0',
     'Referer': 'https://www.udemy.com/join/login-popup/',
     'Accept': '*/*',
     'Accept-Language': 'en-US,en;q=0.5',
-    'Accept-Encoding': 'gzip, deflate, br',
     'Connection': 'keep-alive'
 }
+# name: (type, help) of every metric served by the metrics endpoint
+METRICS = {
+    'udemy_dl_downloaded_bytes_total': ('counter', 'Bytes received from the video hosts.'),
+    'udemy_dl_chunks_total': ('counter', 'Finished chunk and segment requests by outcome.'),
+    'udemy_dl_retries_total': ('counter', 'Retried requests by error.'),
+    'udemy_dl_streams_total': ('counter', 'Finished videos by outcome.'),
+    'udemy_dl_queued_lectures': ('gauge', 'Lectures waiting for a worker.'),
+    'udemy_dl_active_lectures': ('gauge', 'Lectures being downloaded.'),
+    'udemy_dl_active_streams': ('gauge', 'Videos being downloaded.'),
+    'udemy_dl_chunks_in_flight': ('gauge', 'Chunk and segment requests in flight.'),
+    'udemy_dl_host_requests_in_flight': ('gauge', 'Chunk and segment requests in flight, '
+                                                  'each holding a connection, per video host.'),
+    'udemy_dl_host_concurrency_limit': ('gauge', 'Parallel requests allowed per video host.'),
+    'udemy_dl_host_chunk_size_bytes': ('gauge', 'Chunk size per video host.'),
+    'udemy_dl_circuit_open': ('gauge', '1 while requests to a video host are paused.'),
+    'udemy_dl_write_queue_bytes': ('gauge', 'Bytes waiting for the writer threads.'),
+    'udemy_dl_write_waits_total': ('counter', 'Reads paused because the writer queue was full.'),
+    'udemy_dl_retry_budget_tokens': ('gauge', 'Retries left in the budget of the run.'),
+    'udemy_dl_stream_remaining_bytes': ('gauge', 'Bytes left of each video being downloaded.'),
+    'udemy_dl_stream_last_progress_seconds': ('gauge', 'Unix time of the last bytes received '
+                                                       'for each video being downloaded.'),
+    'udemy_dl_chunk_seconds': ('histogram', 'Duration of chunk and segment requests.'),
+    'udemy_dl_chunk_latency_seconds': ('histogram', 'Time to the response headers '
+                                                    'of chunk and segment requests.'),
+}
 
 
-def coroutine_retry(retry_times: int = 5, sleep: int = 1):
+class IntegrityError(Exception):
+    """
+    The server answered a range request with something else than the requested bytes.
     """
-    retry coroutine at most `retry_time` times when encountering exception
-    :param retry_times:
-    :param sleep:
+
+
+class ExpiredUrlError(Exception):
+    """
+    A signed stream URL expired, the request is retried on a refreshed one.
+    """
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """
+    Connection failures, timeouts, truncated or mismatched bodies and overload or server errors
+    are worth another attempt, other error responses and everything else are not.
+    :param exc:
+    :return:
+    """
+    import aiohttp
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status in RETRYABLE_STATUSES
+    return isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError,
+                            IntegrityError, ExpiredUrlError))
+
+
+def retry_after(exc: BaseException) -> float:
+    """
+    seconds asked for by the Retry-After header of an error response, 0 without one
+    :param exc:
     :return:
     """
+    headers = getattr(exc, 'headers', None) or {}
+    try:
+        return min(float(headers.get('Retry-After', 0)), RETRY_MAX_DELAY)
+    except ValueError:
+        # HTTP-date form
+        return 0.0
+
+
+class RetryPolicy:
+    """
+    Decorator retrying a coroutine function `attempts` times on retryable errors,
+    with exponential backoff and full jitter.
+    All retries of the run draw from one budget of `budget` tokens,
+    and every success earns back a fraction of a token,
+    so a failing host makes the run give up instead of retrying for hours.
+    An expired URL, refreshed by the call that hit it, is retried right away
+    without using an attempt or a token, up to URL_REFRESHES times in a row.
+    """
+
+    def __init__(self, attempts: int = RETRY_ATTEMPTS, budget: int = RETRY_BUDGET):
+        self.configure(attempts, budget)
+
+    def configure(self, attempts: int, budget: int) -> None:
+        self.attempts = attempts
+        self.budget = budget
+        self.tokens = float(budget)
+
+    @staticmethod
+    def delay(attempt: int) -> float:
+        return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
 
-    def wrap(func):
-        async def wrap2(*args, **kwargs):
-            for i in range(retry_times + 1):
+    def __call__(self, func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            attempt = 0
+            refreshes = 0
+            while True:
                 try:
-                    return await func(*args, **kwargs)
-                except:
-                    logging.exception("")
-                    if i == retry_times:
+                    result = await func(*args, **kwargs)
+                except Exception as exc:
+                    if isinstance(exc, ExpiredUrlError) and refreshes < URL_REFRESHES:
+                        refreshes += 1
+                        continue
+                    refreshes = 0
+                    attempt += 1
+                    if not is_retryable(exc) or attempt > self.attempts:
                         raise
-                    await asyncio.sleep(sleep)
+                    if self.tokens < 1:
+                        logging.warning(f"{func.__qualname__}: {type(exc).__name__}: {exc}, "
+                                        f"retry budget exhausted")
+                        events.emit('retry_budget_exhausted', call=func.__qualname__,
+                                    error=f"{type(exc).__name__}: {exc}")
+                        raise
+                    self.tokens -= 1
+                    delay = max(self.delay(attempt), retry_after(exc))
+                    logging.warning(f"{func.__qualname__}: {type(exc).__name__}: {exc}, "
+                                    f"retry {attempt}/{self.attempts} in {delay:.1f}s")
+                    metrics.inc('udemy_dl_retries_total', error=type(exc).__name__)
+                    events.emit('retry', call=func.__qualname__, attempt=attempt, delay=delay,
+                                error=f"{type(exc).__name__}: {exc}")
+                    await asyncio.sleep(delay)
+                else:
+                    self.tokens = min(self.budget, self.tokens + RETRY_BUDGET_REFILL)
+                    return result
+
+        return wrapper
+
+
+retry = RetryPolicy()
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms of the run, rendered in the Prometheus text format.
+    Gauges derived from other objects are refreshed by `collectors` right before rendering.
+    """
+
+    def __init__(self):
+        self.values: Dict[Tuple[str, tuple], float] = {}
+        # cumulative bucket counts, then sum and count
+        self.histograms: Dict[Tuple[str, tuple], List[float]] = {}
+        self.collectors: List[Callable[[], None]] = []
+
+    @staticmethod
+    def key(name: str, labels: dict) -> Tuple[str, tuple]:
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        key = self.key(name, labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels) -> None:
+        self.values[self.key(name, labels)] = value
+
+    def remove(self, name: str, **labels) -> None:
+        self.values.pop(self.key(name, labels), None)
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        histogram = self.histograms.setdefault(self.key(name, labels),
+                                               [0] * (len(HISTOGRAM_BUCKETS) + 2))
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    @staticmethod
+    def format_labels(labels: tuple) -> str:
+        if not labels:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                   for _, value in labels)
+        return '{' + ','.join(f'{label}="{value}"'
+                              for (label, _), value in zip(labels, escaped)) + '}'
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for name, (type_, help_) in METRICS.items():
+            samples = sorted((labels, value) for (name_, labels), value in self.values.items()
+                             if name_ == name)
+            histograms = sorted((labels, histogram)
+                                for (name_, labels), histogram in self.histograms.items()
+                                if name_ == name)
+            if not samples and not histograms:
+                continue
+            lines.append(f'# HELP {name} {help_}')
+            lines.append(f'# TYPE {name} {type_}')
+            for labels, value in samples:
+                lines.append(f'{name}{self.format_labels(labels)} {value}')
+            for labels, histogram in histograms:
+                bounds = HISTOGRAM_BUCKETS + ('+Inf',)
+                counts = histogram[:-2] + [histogram[-1]]
+                for bound, count in zip(bounds, counts):
+                    bucket_labels = self.format_labels(labels + (('le', str(bound)),))
+                    lines.append(f'{name}_bucket{bucket_labels} {count}')
+                lines.append(f'{name}_sum{self.format_labels(labels)} {histogram[-2]}')
+                lines.append(f'{name}_count{self.format_labels(labels)} {histogram[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+class EventLog:
+    """
+    Stream and range lifecycle events appended to a JSON lines file,
+    one object per line with the Unix `time` and the `event` name.
+    Every line is flushed at once, so the file can be followed while downloading.
+    Events are dropped while no file is open.
+    """
+
+    def __init__(self):
+        self.file = None
+
+    def open(self, file_path: FilePath) -> None:
+        self.file = open(file_path, 'a', encoding='utf-8', buffering=1)
+
+    def emit(self, event: str, **fields) -> None:
+        if self.file is not None:
+            self.file.write(json.dumps({'time': time.time(), 'event': event, **fields}) + '\n')
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class Span:
+    """
+    Span of a Tracer, timed while used as a context manager, with `with` or `async with`.
+    """
+
+    def __init__(self, tracer: 'Tracer', name: str, category: str, args: dict):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = 0.0
+
+    def __enter__(self) -> 'Span':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if self.tracer.enabled:
+            if exc_type is not None:
+                self.args['error'] = exc_type.__name__
+            self.tracer.add(self.name, self.category, self.start, time.perf_counter(), self.args)
+
+    async def __aenter__(self) -> 'Span':
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self.__exit__(exc_type, exc, tb)
+
+
+class Tracer:
+    """
+    Timed spans in the Chrome trace event format, for chrome://tracing or ui.perfetto.dev.
+    Every asyncio task gets a track of its own, so spans of concurrent requests never overlap
+    and the spans of one request nest: connection, headers, body reads and disk writes.
+    Writer threads get a track each as well.
+    Spans are only recorded after `enable`.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events: List[dict] = []
+        self.tracks: 'weakref.WeakKeyDictionary[asyncio.Task, int]' = weakref.WeakKeyDictionary()
+        self.thread_tracks: Dict[int, int] = {}
+        self.track_ids = itertools.count(1)
+        self.started = time.perf_counter()
+
+    def enable(self) -> None:
+        self.enabled = True
+        self.started = time.perf_counter()
+
+    def track(self) -> int:
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        if task is None:
+            if threading.current_thread() is threading.main_thread():
+                return 0
+            thread = threading.get_ident()
+            if thread not in self.thread_tracks:
+                self.thread_tracks[thread] = next(self.track_ids)
+            return self.thread_tracks[thread]
+        if task not in self.tracks:
+            self.tracks[task] = next(self.track_ids)
+        return self.tracks[task]
+
+    def add(self, name: str, category: str, start: float, end: float, args: dict) -> None:
+        self.events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(),
+                            'tid': self.track(), 'ts': (start - self.started) * 1e6,
+                            'dur': (end - start) * 1e6, 'args': args})
+
+    def span(self, name: str, category: str, **args) -> 'Span':
+        return Span(self, name, category, args)
+
+    def trace_configs(self) -> List[aiohttp.TraceConfig]:
+        """
+        :return: aiohttp hooks adding spans for connection waits, DNS, connects
+                 and the time until response headers, none while disabled
+        """
+        if not self.enabled:
+            return []
+        import aiohttp
+        config = aiohttp.TraceConfig()
+
+        def hook(name: str, start_signal, end_signal) -> None:
+            async def on_start(session, context, params):
+                setattr(context, name, time.perf_counter())
+
+            async def on_end(session, context, params):
+                start = getattr(context, name, None)
+                if start is not None:
+                    self.add(name, 'http', start, time.perf_counter(), {})
+
+            start_signal.append(on_start)
+            end_signal.append(on_end)
+
+        hook('wait for connection', config.on_connection_queued_start,
+             config.on_connection_queued_end)
+        hook('dns', config.on_dns_resolvehost_start, config.on_dns_resolvehost_end)
+        hook('connect', config.on_connection_create_start, config.on_connection_create_end)
+        hook('request to headers', config.on_request_start, config.on_request_end)
+        return [config]
+
+    def save(self, file_path: FilePath) -> None:
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+
+metrics = Metrics()
+events = EventLog()
+tracer = Tracer()
+
+
+def missing_ranges(completed: Iterable[Tuple[Start, Stop]], size: int) -> List[Tuple[Start, Stop]]:
+    """
+    byte ranges of a file of `size` bytes not covered by `completed`.
+    Like HTTP ranges, bytes are numbered from 0 and both ends are inclusive.
+    :param completed:
+    :param size:
+    :return:
+    """
+    gaps = []
+    position = 0
+    for start, stop in sorted(completed):
+        if start > position:
+            gaps.append((position, start - 1))
+        position = max(position, stop + 1)
+    if position < size:
+        gaps.append((position, size - 1))
+    return gaps
+
+
+class AdjustableLimit:
+    """
+    Semaphore whose limit can be changed while it is in use.
+    Lowering the limit lets holders finish, new acquirers wait until usage drops below it.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self.waiters: Deque[asyncio.Future] = collections.deque()
+
+    def set_limit(self, limit: int) -> None:
+        self.limit = max(1, limit)
+        self.wake_up()
+
+    def wake_up(self) -> None:
+        while self.waiters and self.in_use < self.limit:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self.in_use += 1
+
+    async def acquire(self) -> None:
+        if self.in_use < self.limit and not self.waiters:
+            self.in_use += 1
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # the slot was handed over right before the cancellation
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        self.in_use -= 1
+        self.wake_up()
+
+    async def __aenter__(self) -> None:
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self.release()
+
+
+class HostTuner:
+    """
+    AIMD feedback on the chunk size and the number of parallel chunk requests to one host.
+    A chunk size is good when its request lasts about TARGET_CHUNK_SECONDS:
+    faster requests grow it by CHUNKSIZE, slower ones halve it.
+    Concurrency grows by one per round of successful requests and is halved,
+    at most once per second, when a request fails or its latency climbs well above
+    the lowest latency seen, which means requests queue up at the host or on the link.
+    """
+
+    def __init__(self, host: str, chunk_size: int, concurrency: int, max_concurrency: int,
+                 autotune: bool = True):
+        self.host = host
+        self.chunk_size = chunk_size
+        self.concurrency = float(concurrency)
+        self.max_concurrency = max_concurrency
+        self.autotune = autotune
+        self.slots = AdjustableLimit(concurrency)
+        self.min_latency: Optional[float] = None
+        self.last_decrease = 0.0
+
+    def record_success(self, size: int, latency: float, elapsed: float) -> None:
+        """
+        :param size: bytes received
+        :param latency: seconds until the response headers arrived
+        :param elapsed: seconds until the last byte arrived
+        :return:
+        """
+        if not self.autotune:
+            return
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+        if size >= self.chunk_size and elapsed < TARGET_CHUNK_SECONDS / 2:
+            self.chunk_size = min(MAX_CHUNKSIZE, self.chunk_size + CHUNKSIZE)
+        elif elapsed > TARGET_CHUNK_SECONDS * 2:
+            self.chunk_size = max(MIN_CHUNKSIZE, self.chunk_size // 2)
+        if latency > LATENCY_FACTOR * self.min_latency + LATENCY_SLACK:
+            self.decrease()
+        else:
+            self.set_concurrency(self.concurrency + 1 / self.concurrency)
+
+    def record_failure(self) -> None:
+        if not self.autotune:
+            return
+        self.chunk_size = max(MIN_CHUNKSIZE, self.chunk_size // 2)
+        self.decrease()
+
+    def decrease(self) -> None:
+        now = asyncio.get_event_loop().time()
+        if now - self.last_decrease < 1:
+            return
+        self.last_decrease = now
+        self.set_concurrency(self.concurrency / 2)
+
+    def set_concurrency(self, concurrency: float) -> None:
+        concurrency = min(max(1.0, concurrency), self.max_concurrency)
+        if int(concurrency) != int(self.concurrency):
+            logging.debug(f"Host {self.host}: {int(concurrency)} parallel chunks "
+                          f"of {self.chunk_size} bytes")
+        self.concurrency = concurrency
+        self.slots.set_limit(int(concurrency))
+
+
+class CircuitBreaker:
+    """
+    Pauses requests to a host after `threshold` retryable failures in a row.
+    After `cooldown` seconds one request is let through,
+    its success closes the breaker and its failure keeps it open for another `cooldown`.
+    """
+
+    def __init__(self, host: str, threshold: int = BREAKER_THRESHOLD,
+                 cooldown: float = BREAKER_COOLDOWN):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.closed = asyncio.Event()
+        self.closed.set()
+
+    async def wait(self) -> None:
+        loop = asyncio.get_event_loop()
+        while self.opened_at is not None:
+            remaining = self.opened_at + self.cooldown - loop.time()
+            if remaining <= 0:
+                # half open, the next request waits for another cooldown
+                self.opened_at = loop.time()
+                return
+            try:
+                await asyncio.wait_for(self.closed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def record_success(self) -> None:
+        self.failures = 0
+        if self.opened_at is not None:
+            logging.info(f"Host {self.host}: circuit closed")
+            metrics.set('udemy_dl_circuit_open', 0, host=self.host)
+            events.emit('circuit_closed', host=self.host)
+            self.opened_at = None
+            self.closed.set()
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                logging.warning(f"Host {self.host}: {self.failures} failures in a row, "
+                                f"pausing requests for {self.cooldown}s")
+                metrics.set('udemy_dl_circuit_open', 1, host=self.host)
+                events.emit('circuit_open', host=self.host, failures=self.failures)
+            self.opened_at = asyncio.get_event_loop().time()
+            self.closed.clear()
+
+
+class MetricsServer:
+    """
+    HTTP endpoint serving `metrics` in the Prometheus text format at /metrics,
+    started only when a port is given.
+    """
+
+    def __init__(self, host: str = METRICS_HOST, port: Optional[int] = None):
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    @staticmethod
+    async def handle(request):
+        from aiohttp import web
+        return web.Response(body=metrics.render().encode(),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    async def __aenter__(self) -> 'MetricsServer':
+        if self.port is not None:
+            from aiohttp import web
+            app = web.Application()
+            app.router.add_get('/metrics', self.handle)
+            self.runner = web.AppRunner(app, access_log=None)
+            await self.runner.setup()
+            await web.TCPSite(self.runner, self.host, self.port).start()
+            logging.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+class ConnectionPools:
+    """
+    One aiohttp session for the Udemy API host and one for the video CDN hosts,
+    each with a connector of its own, so curriculum requests never queue behind chunk requests.
+    """
+
+    def __init__(self, max_connections: int = MAX_CONNECTIONS,
+                 max_api_connections: int = MAX_API_CONNECTIONS,
+                 max_connections_per_host: int = MAX_CONNECTIONS_PER_HOST,
+                 keepalive_timeout: float = KEEPALIVE_TIMEOUT, dns_cache_ttl: int = DNS_CACHE_TTL,
+                 socket_buffer_size: int = SOCKET_BUFFER_SIZE,
+                 connect_timeout: float = CONNECT_TIMEOUT, read_timeout: float = READ_TIMEOUT):
+        """
+        :param max_connections: open connections to the video hosts
+        :param max_api_connections: open connections to the API host
+        :param max_connections_per_host: 0 for no limit
+        :param keepalive_timeout: seconds an idle connection is kept open
+        :param dns_cache_ttl: seconds a resolved address is reused
+        :param socket_buffer_size: bytes of socket send and receive buffers, 0 for system default
+        :param connect_timeout:
+        :param read_timeout: seconds to wait for the next bytes of a response
+        """
+        import aiohttp
+        self.max_connections = max_connections
+        self.max_api_connections = max_api_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.socket_buffer_size = socket_buffer_size
+        # a long video may take any time, only stalls time out
+        self.timeout = aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout,
+                                             sock_read=read_timeout)
+        self.api: Optional[aiohttp.ClientSession] = None
+        self.cdn: Optional[aiohttp.ClientSession] = None
+
+    def create_socket(self, address_info: tuple) -> socket.socket:
+        family, type_, proto, _, _ = address_info
+        sock = socket.socket(family, type_, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.socket_buffer_size)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.socket_buffer_size)
+        return sock
+
+    def connector(self, limit: int) -> aiohttp.TCPConnector:
+        import aiohttp
+        kwargs = {}
+        if self.socket_buffer_size:
+            if 'socket_factory' in inspect.signature(aiohttp.TCPConnector).parameters:
+                kwargs['socket_factory'] = self.create_socket
+            else:
+                logging.warning("Socket buffer size needs aiohttp 3.12 or later, ignored")
+        return aiohttp.TCPConnector(limit=limit, limit_per_host=self.max_connections_per_host,
+                                    keepalive_timeout=self.keepalive_timeout,
+                                    ttl_dns_cache=self.dns_cache_ttl, **kwargs)
+
+    async def __aenter__(self) -> 'ConnectionPools':
+        import aiohttp
+        self.api = aiohttp.ClientSession(connector=self.connector(self.max_api_connections),
+                                         timeout=self.timeout,
+                                         trace_configs=tracer.trace_configs())
+        self.cdn = aiohttp.ClientSession(connector=self.connector(self.max_connections),
+                                         timeout=self.timeout,
+                                         trace_configs=tracer.trace_configs())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.api.close()
+        await self.cdn.close()
+
+
+async def prewarm(session: aiohttp.ClientSession, url: Url, count: int) -> None:
+    """
+    open `count` connections to the host of `url` with one byte range requests,
+    the connections stay in the pool for the chunk requests that follow
+    :param session:
+    :param url:
+    :param count:
+    :return:
+    """
+    import aiohttp
+
+    async def open_connection():
+        headers = {'User-Agent': HEADERS.get('User-Agent'), 'Range': 'bytes=0-0'}
+        try:
+            async with session.get(url, headers=headers) as resp:
+                await resp.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # the chunk requests open their connections themselves
+            pass
+
+    await asyncio.gather(*(open_connection() for _ in range(count)))
+
+
+def parse_size(size: str, base: int = 1024) -> int:
+    """
+    :param size: number with an optional K, M or G suffix, like 500K or 2.5M
+    :param base: multiplier of the K suffix
+    :return:
+    """
+    multiplier = {'K': base, 'M': base ** 2, 'G': base ** 3}.get(size[-1:].upper(), 1)
+    try:
+        return int(float(size[:-1] if multiplier != 1 else size) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {size}")
+
+
+def parse_rate(rate: str) -> int:
+    """
+    :param rate: bytes per second, with an optional K, M or G suffix, like 500K or 2.5M
+    :return: bytes per second, 0 for no limit
+    """
+    return parse_size(rate)
+
+
+def parse_bitrate(bitrate: str) -> int:
+    """
+    :param bitrate: bits per second, with an optional K, M or G suffix of powers of 1000
+    :return: bits per second
+    """
+    return parse_size(bitrate, 1000)
+
+
+class TokenBucket:
+    """
+    Token bucket counting bytes, refilled continuously at `rate` bytes per second
+    and holding at most BURST_SECONDS of traffic, 0 rate for no limit.
+    A consumer may take more tokens than the bucket holds and then waits off the debt,
+    waiting consumers are served in turn, so traffic stays smooth instead of bursting.
+    """
+
+    def __init__(self, rate: int = 0):
+        self.rate = rate
+        self.tokens = 0.0
+        self.updated = asyncio.get_event_loop().time()
+        self.lock = asyncio.Lock()
+
+    def set_rate(self, rate: int) -> None:
+        self.refill()
+        self.rate = rate
+
+    def refill(self) -> None:
+        now = asyncio.get_event_loop().time()
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate,
+                          self.rate * BURST_SECONDS)
+        self.updated = now
+
+    async def consume(self, size: int) -> None:
+        if not self.rate:
+            return
+        async with self.lock:
+            self.refill()
+            self.tokens -= size
+            if self.tokens < 0:
+                await asyncio.sleep(-self.tokens / self.rate)
+
+
+class RateLimiter:
+    """
+    Bandwidth limits for all downloads together, for each course and for each video,
+    in bytes per second, 0 for no limit.
+    The limits can be changed while downloading with `set_rates`
+    or by editing `rate_file`, which holds lines like `global 10M`, `course 5M` or `stream 1M`.
+    """
+
+    def __init__(self, global_rate: int = 0, course_rate: int = 0, stream_rate: int = 0,
+                 rate_file: Optional[FilePath] = None):
+        self.course_rate = course_rate
+        self.stream_rate = stream_rate
+        self.rate_file = rate_file
+        self.global_bucket = TokenBucket(global_rate)
+        self.course_buckets: Dict[int, TokenBucket] = {}
+        self.stream_buckets: weakref.WeakSet = weakref.WeakSet()
+
+    @property
+    def active(self) -> bool:
+        return bool(self.global_bucket.rate or self.course_rate or self.stream_rate)
+
+    def buckets(self, course_id: int) -> List[TokenBucket]:
+        """
+        :param course_id:
+        :return: the buckets a new video of the course draws from
+        """
+        if course_id not in self.course_buckets:
+            self.course_buckets[course_id] = TokenBucket(self.course_rate)
+        stream_bucket = TokenBucket(self.stream_rate)
+        self.stream_buckets.add(stream_bucket)
+        return [stream_bucket, self.course_buckets[course_id], self.global_bucket]
+
+    def set_rates(self, global_rate: Optional[int] = None, course_rate: Optional[int] = None,
+                  stream_rate: Optional[int] = None) -> None:
+        if global_rate is not None:
+            self.global_bucket.set_rate(global_rate)
+        if course_rate is not None:
+            self.course_rate = course_rate
+            for bucket in self.course_buckets.values():
+                bucket.set_rate(course_rate)
+        if stream_rate is not None:
+            self.stream_rate = stream_rate
+            for bucket in self.stream_buckets:
+                bucket.set_rate(stream_rate)
+        logging.info(f"Rate limits: global {self.global_bucket.rate}, course {self.course_rate}, "
+                     f"stream {self.stream_rate} bytes/s")
+
+    async def watch_rate_file(self) -> None:
+        modified = None
+        while True:
+            try:
+                mtime = os.stat(self.rate_file).st_mtime
+                if mtime != modified:
+                    modified = mtime
+                    with open(self.rate_file) as f:
+                        rates = dict(line.split() for line in f if line.strip())
+                    self.set_rates(*(parse_rate(rates[key]) if key in rates else None
+                                     for key in ('global', 'course', 'stream')))
+            except (OSError, ValueError, argparse.ArgumentTypeError):
+                logging.warning(f"Cannot read rate file {self.rate_file}", exc_info=True)
+            await asyncio.sleep(RATE_FILE_POLL_INTERVAL)
+
+
+class DownloadScheduler:
+    """
+    One scheduler shared by the whole download tree.
+    Lectures are queued and run by a fixed pool of `max_streams` workers,
+    and every chunk request holds one of `max_chunks` slots.
+    Each video keeps at most `window_size` chunks in flight,
+    and chunk size and concurrency for each video host are tuned by a HostTuner.
+    Captions, articles and external links have a lane of their own
+    with `max_small_assets` slots, so they never wait behind video chunks.
+    Received bytes are paced by the `limiter` and written by the `writer` threads,
+    and finished videos get a `hash_algorithm` digest file next to them.
+    Each video host has a CircuitBreaker opening after `breaker_threshold` failures in a row.
+    """
+
+    def __init__(self, max_streams: int = MAX_STREAMS,
+                 max_chunks: int = MAX_CHUNKS, window_size: int = WINDOW_SIZE,
+                 chunk_size: int = CHUNKSIZE, autotune: bool = True,
+                 max_small_assets: int = MAX_SMALL_ASSETS,
+                 limiter: Optional[RateLimiter] = None, hash_algorithm: Optional[str] = None,
+                 breaker_threshold: int = BREAKER_THRESHOLD,
+                 breaker_cooldown: float = BREAKER_COOLDOWN,
+                 writer: Optional[DiskWriter] = None):
+        self.max_streams = max_streams
+        self.hash_algorithm = hash_algorithm
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.writer = writer if writer is not None else DiskWriter()
+        self.max_chunks = max_chunks
+        self.small_asset_slots = asyncio.Semaphore(max_small_assets)
+        self.window_size = window_size
+        self.chunk_size = chunk_size
+        self.autotune = autotune
+        self.tuners: Dict[str, HostTuner] = {}
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        # video hosts with connections opened ahead of the first chunk burst
+        self.warm_hosts = set()
+        self.chunk_slots = asyncio.Semaphore(max_chunks)
+        self.queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        # keeps jobs of equal priority in submission order
+        self.sequence = itertools.count()
+        self.workers: List[asyncio.Task] = []
+        # lectures whose job raised, the run exits non-zero when there are any
+        self.failures = 0
+
+    def tuner(self, host: str) -> HostTuner:
+        if host not in self.tuners:
+            if self.autotune:
+                concurrency = min(self.window_size, self.max_chunks)
+            else:
+                concurrency = self.max_chunks
+            self.tuners[host] = HostTuner(host, self.chunk_size, concurrency, self.max_chunks,
+                                          self.autotune)
+        return self.tuners[host]
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        if host not in self.breakers:
+            self.breakers[host] = CircuitBreaker(host, self.breaker_threshold,
+                                                 self.breaker_cooldown)
+        return self.breakers[host]
+
+    def submit(self, job: Callable[[], Awaitable], priority: int = 0) -> asyncio.Future:
+        """
+        queue `job` for a free worker slot
+        :param job: coroutine function taking no argument
+        :param priority: jobs with lower priority start first
+        :return: future resolved when `job` finishes, with its exception when it fails
+        """
+        future = asyncio.get_event_loop().create_future()
+        self.queue.put_nowait((priority, next(self.sequence), job, future))
+        return future
+
+    def update_metrics(self) -> None:
+        metrics.set('udemy_dl_queued_lectures', self.queue.qsize())
+        metrics.set('udemy_dl_retry_budget_tokens', retry.tokens)
+        self.writer.update_metrics()
+        for host, tuner in self.tuners.items():
+            metrics.set('udemy_dl_host_requests_in_flight', tuner.slots.in_use, host=host)
+            metrics.set('udemy_dl_host_concurrency_limit', tuner.slots.limit, host=host)
+            metrics.set('udemy_dl_host_chunk_size_bytes', tuner.chunk_size, host=host)
+
+    async def worker(self) -> None:
+        while True:
+            _, _, job, future = await self.queue.get()
+            metrics.inc('udemy_dl_active_lectures')
+            try:
+                async with tracer.span('lecture', 'scheduler'):
+                    await job()
+            except Exception as exc:
+                # one broken lecture must not stop the others
+                logging.exception("")
+                self.failures += 1
+                if not future.done():
+                    future.set_exception(exc)
+            finally:
+                metrics.inc('udemy_dl_active_lectures', -1)
+                if not future.done():
+                    future.set_result(None)
+                self.queue.task_done()
+
+    async def __aenter__(self) -> 'DownloadScheduler':
+        self.workers = [asyncio.ensure_future(self.worker()) for _ in range(self.max_streams)]
+        metrics.collectors.append(self.update_metrics)
+        if self.limiter.rate_file is not None:
+            self.workers.append(asyncio.ensure_future(self.limiter.watch_rate_file()))
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        metrics.collectors.remove(self.update_metrics)
+        self.writer.close()
+
+
+class CurriculumCache:
+    """
+    Curriculum responses kept on disk, one JSON file per course id.
+    Within `ttl` seconds of the last fetch the cached curriculum is used without any request,
+    after that every page is revalidated with its ETag or Last-Modified validator.
+    A partial curriculum, from a run that stopped reading it early, is only revalidated.
+    """
+
+    def __init__(self, directory: FilePath, ttl: float = CURRICULUM_CACHE_TTL):
+        self.directory = os.path.realpath(os.path.expanduser(directory))
+        self.ttl = ttl
+
+    def file_path(self, course_id: int) -> FilePath:
+        return os.path.join(self.directory, f'course-{course_id}.json')
+
+    def load(self, course_id: int) -> Tuple[float, List[dict]]:
+        """
+        :param course_id:
+        :return: time of the last fetch, 0 for a partial curriculum,
+            and the cached pages in curriculum order
+        """
+        try:
+            with open(self.file_path(course_id), encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return 0.0, []
+        return cached['fetched'] if cached.get('complete', True) else 0.0, cached['pages']
+
+    def is_fresh(self, fetched: float) -> bool:
+        return time.time() - fetched < self.ttl
+
+    async def save(self, course_id: int, pages: List[dict], complete: bool = True) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        await replace_file(self.file_path(course_id), json.dumps(
+            {'fetched': time.time(), 'complete': complete, 'pages': pages}))
+
+
+class DownloadJournal:
+    """
+    SQLite journal kept in the course directory.
+    It records the expected size and state of every asset and the byte ranges
+    already written to its `.part` file, so a restarted run knows what is left
+    without looking at the files.
+    Assets are keyed by their path relative to the course directory.
+    A read-only journal, for plans, never writes to the course directory:
+    a journal file is read as it is, without one the journal is kept in memory.
+    """
+    DOWNLOADING = 'downloading'
+    DONE = 'done'
+
+    def __init__(self, directory: FilePath, read_only: bool = False):
+        import sqlite3
+        self.directory = directory
+        file_path = os.path.join(directory, JOURNAL_FILENAME)
+        if read_only and os.path.exists(file_path):
+            import pathlib
+            # immutable reads it without creating -wal and -shm files,
+            # unless a run left a write-ahead log whose ranges have to be read too
+            mode = 'ro' if os.path.exists(file_path + '-wal') else 'ro&immutable=1'
+            self.connection = sqlite3.connect(
+                f'{pathlib.Path(os.path.abspath(file_path)).as_uri()}?mode={mode}', uri=True)
+        else:
+            self.connection = sqlite3.connect(':memory:' if read_only else file_path)
+            self.create_tables()
+        # one query at startup instead of one per asset
+        self.assets: Dict[str, Tuple[Optional[int], str]] = {
+            path: (size, state)
+            for path, size, state in self.connection.execute("SELECT path, size, state FROM assets")}
+
+    def create_tables(self) -> None:
+        self.connection.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS assets (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                state TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS ranges (
+                path TEXT NOT NULL,
+                start INTEGER NOT NULL,
+                stop INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ranges_path ON ranges (path);
+        """)
+
+    def key(self, file_path: FilePath) -> str:
+        return os.path.relpath(file_path, self.directory)
+
+    def state(self, path: str) -> Optional[str]:
+        return self.assets.get(path, (None, None))[1]
+
+    def size(self, path: str) -> Optional[int]:
+        return self.assets.get(path, (None, None))[0]
+
+    def start(self, path: str, size: Optional[int]) -> None:
+        """
+        record that `path` is being downloaded and expected to be `size` bytes.
+        Ranges recorded for another size belong to another file and are dropped.
+        :param path:
+        :param size:
+        :return:
+        """
+        with self.connection:
+            if self.size(path) != size:
+                self.connection.execute("DELETE FROM ranges WHERE path = ?", (path,))
+            self.connection.execute("INSERT OR REPLACE INTO assets VALUES (?, ?, ?)",
+                                    (path, size, self.DOWNLOADING))
+        self.assets[path] = (size, self.DOWNLOADING)
+
+    def completed_ranges(self, path: str) -> List[Tuple[Start, Stop]]:
+        return self.connection.execute("SELECT start, stop FROM ranges WHERE path = ?",
+                                       (path,)).fetchall()
+
+    def completed_bytes(self, path: str) -> int:
+        if self.state(path) == self.DONE:
+            return self.size(path)
+        return self.connection.execute("SELECT TOTAL(stop - start + 1) FROM ranges WHERE path = ?",
+                                       (path,)).fetchone()[0]
+
+    def reset_ranges(self, path: str) -> None:
+        with self.connection:
+            self.connection.execute("DELETE FROM ranges WHERE path = ?", (path,))
+
+    def add_range(self, path: str, start: Start, stop: Stop) -> None:
+        with self.connection:
+            self.connection.execute("INSERT INTO ranges VALUES (?, ?, ?)", (path, start, stop))
+
+    def finish(self, path: str, size: Optional[int]) -> None:
+        with self.connection:
+            self.connection.execute("DELETE FROM ranges WHERE path = ?", (path,))
+            self.connection.execute("INSERT OR REPLACE INTO assets VALUES (?, ?, ?)",
+                                    (path, size, self.DONE))
+        self.assets[path] = (size, self.DONE)
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def open_preallocated(file_path: FilePath, size: int) -> int:
+    """
+    open `file_path` for positional writes, creating it with `size` bytes reserved.
+    An existing file of the right size is reused as is so that written chunks survive.
+    :param file_path:
+    :param size:
+    :return: file descriptor
+    """
+    fd = os.open(file_path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o666)
+    if os.fstat(fd).st_size != size:
+        os.ftruncate(fd, size)
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                # not supported by every file system, the sparse file works as well
+                pass
+    return fd
+
+
+# Windows has no pwrite and pread, the seek and the read or write of one writer thread
+# must not interleave with those of another
+seek_lock = threading.Lock()
+
+
+def pwrite(fd: int, data: bytes, offset: int) -> None:
+    """
+    write all of `data` to `fd` at `offset` without moving the file position
+    :param fd:
+    :param data:
+    :param offset:
+    :return:
+    """
+    view = memoryview(data)
+    while view:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, view, offset)
+        else:
+            with seek_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+
+def pwritev(fd: int, buffers: List[bytes], offset: int) -> None:
+    """
+    write `buffers` one after another to `fd` at `offset` with as few system calls as possible
+    :param fd:
+    :param buffers:
+    :param offset:
+    :return:
+    """
+    if not hasattr(os, 'pwritev'):
+        pwrite(fd, b''.join(buffers), offset)
+        return
+    views = [memoryview(data) for data in buffers]
+    first = 0
+    while first < len(views):
+        written = os.pwritev(fd, views[first:first + IOV_MAX], offset)
+        offset += written
+        while first < len(views) and written >= len(views[first]):
+            written -= len(views[first])
+            first += 1
+        if written:
+            views[first] = views[first][written:]
+
+
+async def write_file(file_path: FilePath, data: Union[str, bytes]) -> None:
+    """
+    write `data` to `file_path` in the default executor, keeping the event loop free
+    :param file_path:
+    :param data:
+    :return:
+    """
+
+    def write():
+        if isinstance(data, bytes):
+            with open(file_path, 'wb') as f:
+                f.write(data)
+        else:
+            with open(file_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+
+    await asyncio.get_event_loop().run_in_executor(None, write)
+
+
+@retry
+async def fetch_json(session: aiohttp.ClientSession, url: Url) -> dict:
+    with tracer.span('fetch json', 'api', url=url):
+        async with session.get(url, headers=HEADERS) as response:
+            response.raise_for_status()
+            return await response.json()
+
+
+@retry
+async def fetch_text(session: aiohttp.ClientSession, url: Url) -> str:
+    with tracer.span('fetch text', 'cdn', url=url):
+        async with session.get(url, headers={'User-Agent': HEADERS.get('User-Agent')}) as response:
+            response.raise_for_status()
+            return await response.text()
+
+
+@retry
+async def fetch_cacheable_json(session: aiohttp.ClientSession, url: Url,
+                               cached: Optional[dict] = None) -> dict:
+    """
+    :param session:
+    :param url:
+    :param cached: entry previously returned for `url`, makes the request conditional
+    :return: cache entry with `url`, `etag`, `last_modified` and the response as `data`,
+             `cached` itself when the server answers 304 Not Modified
+    """
+    headers = dict(HEADERS)
+    if cached is not None:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+    with tracer.span('fetch curriculum page', 'api', url=url):
+        async with session.get(url, headers=headers) as response:
+            if cached is not None and response.status == 304:
+                return cached
+            response.raise_for_status()
+            return {'url': url, 'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'data': await response.json()}
+
+
+async def replace_file(file_path: FilePath, data: Union[str, bytes]) -> None:
+    """
+    write `data` to a temporary file then rename it to `file_path`,
+    so that `file_path` is never left half written
+    :param file_path:
+    :param data:
+    :return:
+    """
+    await write_file(file_path + '.tmp', data)
+    os.replace(file_path + '.tmp', file_path)
+
+
+async def gather_all(*coroutines: Awaitable) -> None:
+    """
+    run `coroutines` concurrently, then raise the first failure once all of them have finished
+    :param coroutines:
+    :return:
+    """
+    for result in await asyncio.gather(*coroutines, return_exceptions=True):
+        if isinstance(result, BaseException):
+            raise result
+
+
+async def iterate(items: Iterable) -> AsyncIterator:
+    for item in items:
+        yield item
 
-        return wrap2
 
-    return wrap
+def pread(fd: int, size: int, offset: int) -> bytes:
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, offset)
+    with seek_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
 
 
-def partition(start: int, stop: int, interval_size: int) \
-        -> Generator[Tuple[Index, Start, Stop], None, None]:
+def check_range_response(resp: aiohttp.ClientResponse, start: Start, stop: Stop,
+                         size: Optional[int]) -> None:
     """
-    partition range ranging from `start` to `stop` to intervals size of each is `size`,
-    except the last interval.
+    make sure `resp` carries bytes `start` to `stop` of a file of `size` bytes
+    :param resp:
     :param start:
     :param stop:
-    :param interval_size:
+    :param size: None when the size of the file is not known
     :return:
     """
-    index = 0
-    while start <= stop:
-        yield index, start, min(start + interval_size - 1, stop)
-        start += interval_size
-        index += 1
+    resp.raise_for_status()
+    if resp.status != 206:
+        raise IntegrityError(f"{resp.url}: status {resp.status} instead of 206 "
+                             f"for bytes {start}-{stop}")
+    content_range = resp.headers.get('Content-Range', '')
+    expected = f'bytes {start}-{stop}/'
+    if not content_range.startswith(expected) or \
+            size is not None and content_range != f'{expected}{size}':
+        raise IntegrityError(f"{resp.url}: Content-Range {content_range} "
+                             f"instead of {expected}{'*' if size is None else size}")
+
+
+class HostRequest:
+    """
+    Request of a chunk or HLS segment to a video host, used as an async context manager.
+    Entering waits for the circuit breaker of the host, a slot of the host tuner
+    and a chunk slot of the scheduler, which are held until exit.
+    On exit the outcome is recorded in the tuner, the breaker, the metrics and,
+    for a failure, a `<span>_failed` event; an expired URL is refreshed
+    without any penalty for the host.
+    """
+
+    def __init__(self, scheduler: DownloadScheduler, tuner: HostTuner, buckets: List[TokenBucket],
+                 refresh: Callable[[Url], Awaitable[None]], span: str, file_path: FilePath,
+                 **fields):
+        """
+        :param refresh: called with the URL of the request when it has expired
+        :param span: name of the trace span and of the failure event
+        :param file_path: of the video
+        :param fields: of the trace span and the failure event
+        """
+        self.scheduler = scheduler
+        self.tuner = tuner
+        self.breaker = scheduler.breaker(tuner.host)
+        self.buckets = buckets
+        self.refresh = refresh
+        self.span = span
+        self.file_path = file_path
+        self.fields = fields
+        self.stack: Optional[contextlib.AsyncExitStack] = None
+        self.url: Optional[Url] = None
+        self.started = 0.0
+        # seconds up to the response headers, up to the first byte of the body and in all
+        self.latency = 0.0
+        self.first_byte: Optional[float] = None
+        self.seconds = 0.0
+        # bytes read
+        self.size = 0
+
+    async def __aenter__(self) -> 'HostRequest':
+        await self.breaker.wait()
+        async with contextlib.AsyncExitStack() as stack:
+            await stack.enter_async_context(self.tuner.slots)
+            await stack.enter_async_context(self.scheduler.chunk_slots)
+            await stack.enter_async_context(
+                tracer.span(self.span, 'chunk', file=self.file_path, **self.fields))
+            self.stack = stack.pop_all()
+        self.started = asyncio.get_event_loop().time()
+        metrics.inc('udemy_dl_chunks_in_flight')
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        metrics.inc('udemy_dl_chunks_in_flight', -1)
+        try:
+            if exc is None:
+                self.seconds = asyncio.get_event_loop().time() - self.started
+                self.tuner.record_success(self.size, self.latency, self.seconds)
+                self.breaker.record_success()
+                metrics.inc('udemy_dl_chunks_total', outcome='done')
+                metrics.observe('udemy_dl_chunk_seconds', self.seconds)
+                metrics.observe('udemy_dl_chunk_latency_seconds', self.latency)
+            elif isinstance(exc, Exception):
+                metrics.inc('udemy_dl_chunks_total', outcome='failed')
+                events.emit(f'{self.span}_failed', file=self.file_path, url=self.url,
+                            **self.fields, error=f"{type(exc).__name__}: {exc}")
+                if isinstance(exc, ExpiredUrlError):
+                    # not a failure of the host, no penalty for the tuner or breaker
+                    await self.refresh(self.url)
+                else:
+                    self.tuner.record_failure()
+                    if is_retryable(exc):
+                        self.breaker.record_failure()
+        finally:
+            await self.stack.__aexit__(exc_type, exc, tb)
+
+    async def fetch(self, session: aiohttp.ClientSession, url: Url,
+                    byte_range: Optional[Tuple[Start, Stop]], size: Optional[int],
+                    write: Callable[[bytes], Awaitable[None]]) -> None:
+        """
+        request `url` and hand its body to `write` read by read, within the token buckets
+        :param session:
+        :param url:
+        :param byte_range: first and last byte to request, None for the whole resource
+        :param size: of the whole resource for a byte range, None when it is not known
+        :param write:
+        :return:
+        """
+        self.url = url
+        headers = {'User-Agent': HEADERS.get('User-Agent')}
+        length = None
+        if byte_range is not None:
+            # Request only part of an entity. Bytes are numbered from 0
+            # Range: bytes=500-999
+            headers['Range'] = 'bytes={}-{}'.format(*byte_range)
+            length = byte_range[1] - byte_range[0] + 1
+        loop = asyncio.get_event_loop()
+        read_size = SHAPED_READ_SIZE if self.scheduler.limiter.active else CHUNKSIZE
+        async with session.get(url, headers=headers) as resp:
+            self.latency = loop.time() - self.started
+            if resp.status in EXPIRED_URL_STATUSES:
+                raise ExpiredUrlError(f"{url}: status {resp.status}")
+            if byte_range is not None:
+                check_range_response(resp, *byte_range, size)
+            else:
+                resp.raise_for_status()
+            while length is None or self.size < length:
+                async with tracer.span('read', 'chunk'):
+                    chunk = await resp.content.read(
+                        read_size if length is None else min(read_size, length - self.size))
+                if not chunk:
+                    if length is None:
+                        break
+                    raise IntegrityError("{}: bytes {}-{} ended after {} bytes".format(
+                        url, *byte_range, self.size))
+                if self.first_byte is None:
+                    # latency is up to the response headers, this up to the body
+                    self.first_byte = loop.time() - self.started
+                for bucket in self.buckets:
+                    await bucket.consume(len(chunk))
+                await write(chunk)
+                self.size += len(chunk)
+                metrics.inc('udemy_dl_downloaded_bytes_total', len(chunk))
+                metrics.set('udemy_dl_stream_last_progress_seconds', time.time(),
+                            file=self.file_path)
+
+
+class StreamingHasher:
+    """
+    Hash of a file written out of order, computed while it is downloaded.
+    Bytes written at the hashed position, or reaching past it, are hashed right away,
+    bytes written ahead of it are read back from the file,
+    normally from the page cache, once the gap before them is filled.
+    Updates may come from several writer threads.
+    """
+
+    def __init__(self, algorithm: str, fd: int):
+        self.hash = hashlib.new(algorithm)
+        self.fd = fd
+        self.position = 0
+        # ranges written ahead of the hashed position
+        self.ahead: List[Tuple[Start, Stop]] = []
+        self.lock = threading.Lock()
+
+    def update(self, offset: int, data: bytes) -> None:
+        with self.lock:
+            if offset <= self.position < offset + len(data):
+                # a retried range may start before the hashed position, in another run of bytes
+                self.hash.update(memoryview(data)[self.position - offset:])
+                self.position = offset + len(data)
+            elif offset > self.position:
+                self.ahead.append((offset, offset + len(data) - 1))
+            self.catch_up()
+
+    def catch_up(self) -> None:
+        self.ahead.sort()
+        while self.ahead and self.ahead[0][0] <= self.position:
+            _, stop = self.ahead.pop(0)
+            while self.position <= stop:
+                data = pread(self.fd, min(CHUNKSIZE, stop - self.position + 1), self.position)
+                self.hash.update(data)
+                self.position += len(data)
+
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
+
+class DiskWriter:
+    """
+    File writes of the downloads run on a pool of writer threads,
+    so a slow or network-backed disk never stalls the sockets on the event loop.
+    At most `queue_size` bytes wait for the threads;
+    a write that does not fit pauses the network read feeding it until enough is written.
+    The `fsync` policy is one of FSYNC_POLICIES.
+    Operations on a file descriptor are counted until a thread is done with them,
+    and `close_file` waits for them: a closed descriptor number is soon reused
+    by another file, which a late write would corrupt.
+    """
+
+    def __init__(self, threads: int = WRITER_THREADS, queue_size: int = WRITE_QUEUE_SIZE,
+                 fsync: str = 'none'):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads,
+                                                              thread_name_prefix='writer')
+        self.queue_size = queue_size
+        self.fsync = fsync
+        # bytes handed to the threads and not written yet
+        self.queued = 0
+        self.room = asyncio.Event()
+        # operations handed to the threads and not done yet, by file descriptor
+        self.pending: Dict[int, int] = {}
+        self.settled = asyncio.Event()
+
+    async def run(self, function: Callable, *args):
+        """
+        :param function: blocking file operation
+        :param args:
+        :return: what `function` returns, once it has run on a writer thread
+        """
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, functools.partial(function, *args))
+
+    async def write(self, fd: int, buffers: List[bytes], offset: int,
+                    hasher: Optional[StreamingHasher] = None) -> asyncio.Future:
+        """
+        Queue a write of `buffers` to `fd` at `offset`, waiting for room in the queue first.
+        :param fd:
+        :param buffers: adjacent bytes, written with one vectored write
+        :param offset:
+        :param hasher: updated with `buffers` once they are written
+        :return: future resolved when the bytes are written
+        """
+        size = sum(len(data) for data in buffers)
+        if self.queued and self.queued + size > self.queue_size:
+            metrics.inc('udemy_dl_write_waits_total')
+            while self.queued and self.queued + size > self.queue_size:
+                self.room.clear()
+                await self.room.wait()
+        return self.submit(fd, size, self.write_buffers, fd, buffers, offset, size, hasher)
+
+    def submit(self, fd: int, size: int, function: Callable, *args) -> asyncio.Future:
+        """
+        Run `function` on a writer thread as an operation on `fd`.
+        Cancelling the returned future does not stop a running operation,
+        `close_file` still waits for it.
+        :param fd:
+        :param size: bytes the operation holds in the queue
+        :param function: blocking file operation
+        :param args:
+        :return: future resolved with what `function` returns
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.queued += size
+        self.pending[fd] = self.pending.get(fd, 0) + 1
+        work = self.executor.submit(function, *args)
+        work.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(self.done, fd, size, work, future))
+        return future
+
+    def done(self, fd: int, size: int, work: concurrent.futures.Future,
+             future: asyncio.Future) -> None:
+        self.queued -= size
+        self.room.set()
+        self.pending[fd] -= 1
+        if not self.pending[fd]:
+            del self.pending[fd]
+            self.settled.set()
+        if not future.done():
+            if work.exception() is not None:
+                future.set_exception(work.exception())
+            else:
+                future.set_result(work.result())
+
+    @staticmethod
+    def write_buffers(fd: int, buffers: List[bytes], offset: int, size: int,
+                      hasher: Optional[StreamingHasher]) -> None:
+        with tracer.span('write', 'disk', offset=offset, size=size):
+            pwritev(fd, buffers, offset)
+        if hasher is not None:
+            with tracer.span('hash', 'disk', offset=offset, size=size):
+                for data in buffers:
+                    hasher.update(offset, data)
+                    offset += len(data)
+
+    async def sync(self, fd: int) -> None:
+        """
+        flush the written data of `fd` to disk on a writer thread
+        :param fd:
+        :return:
+        """
+        with tracer.span('sync', 'disk'):
+            await self.submit(fd, 0, getattr(os, 'fdatasync', os.fsync), fd)
+
+    async def close_file(self, fd: int) -> None:
+        """
+        close `fd` once the writer threads are done with it;
+        a cancelled caller stops waiting, `fd` is still closed after its last operation
+        :param fd:
+        :return:
+        """
+        await asyncio.shield(self.settle_and_close(fd))
+
+    async def settle_and_close(self, fd: int) -> None:
+        while self.pending.get(fd):
+            self.settled.clear()
+            await self.settled.wait()
+        os.close(fd)
+
+    def update_metrics(self) -> None:
+        metrics.set('udemy_dl_write_queue_bytes', self.queued)
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+
+
+class PartFile:
+    """
+    Preallocated `.part` file of a video written at chunk offsets through a DiskWriter,
+    optionally hashed while it is written.
+    It does blocking I/O on creation, so it is created on a writer thread with `DiskWriter.run`.
+    """
+
+    def __init__(self, file_path: FilePath, size: int, writer: DiskWriter,
+                 hash_algorithm: Optional[str] = None,
+                 completed: Iterable[Tuple[Start, Stop]] = ()):
+        """
+        :param file_path:
+        :param size:
+        :param writer:
+        :param hash_algorithm: any hashlib algorithm, None for no hash
+        :param completed: ranges written by an earlier run, hashed first
+        """
+        self.file_path = file_path
+        self.size = size
+        self.writer = writer
+        self.fd = open_preallocated(file_path, size)
+        self.hasher = None
+        if hash_algorithm is not None:
+            self.hasher = StreamingHasher(hash_algorithm, self.fd)
+            self.hasher.ahead.extend(completed)
+            self.hasher.catch_up()
+
+    def chunk(self, start: Start) -> 'PartFileRange':
+        return PartFileRange(self, start)
+
+    def check_size(self) -> None:
+        size = os.fstat(self.fd).st_size
+        if size != self.size:
+            raise IntegrityError(f"{self.file_path}: {size} bytes instead of {self.size}")
+        if self.hasher is not None and self.hasher.position != self.size:
+            raise IntegrityError(f"{self.file_path}: {self.hasher.position} bytes hashed "
+                                 f"instead of {self.size}")
+
+    async def close(self) -> None:
+        await self.writer.close_file(self.fd)
+
+
+class PartFileRange:
+    """
+    Bytes of one chunk of a PartFile, received in order from `start` on.
+    Adjacent reads are gathered and handed to the writer in runs of WRITE_COALESCE_SIZE bytes,
+    as the bytes objects aiohttp received: they go to disk with one vectored write, uncopied.
+    """
+
+    def __init__(self, part_file: PartFile, start: Start):
+        self.part_file = part_file
+        # position of the first buffered byte
+        self.offset = start
+        self.buffers: List[bytes] = []
+        self.buffered = 0
+        self.writes: List[asyncio.Future] = []
+
+    async def write(self, data: bytes) -> None:
+        """
+        add `data` after the bytes written so far, waits while the writer queue is full
+        :param data:
+        :return:
+        """
+        self.buffers.append(data)
+        self.buffered += len(data)
+        if self.buffered >= WRITE_COALESCE_SIZE:
+            await self.submit()
+
+    async def submit(self) -> None:
+        buffers, offset = self.buffers, self.offset
+        self.buffers, self.offset, self.buffered = [], offset + self.buffered, 0
+        part_file = self.part_file
+        self.writes.append(await part_file.writer.write(part_file.fd, buffers, offset,
+                                                        part_file.hasher))
+
+    async def flush(self) -> None:
+        """
+        write the buffered bytes and wait until all bytes of the range are written,
+        and synced to disk with fsync policy 'range', before the journal records them
+        :return:
+        """
+        if self.buffers:
+            await self.submit()
+        writes = list(self.writes)
+        await self.drain()
+        for write in writes:
+            write.result()
+        if self.part_file.writer.fsync == 'range':
+            await self.part_file.writer.sync(self.part_file.fd)
+
+    async def drain(self) -> None:
+        """
+        Wait until the writer threads are done with every write handed over so far,
+        written or failed. Unlike gather, waiting does not cancel them when the range is
+        cancelled, so a retry never races the writes of the attempt before it.
+        :return:
+        """
+        writes = list(self.writes)
+        if writes:
+            await asyncio.wait(writes)
+        # writes are only appended, a cancelled wait keeps them for the next drain
+        del self.writes[:len(writes)]
+        for write in writes:
+            if not write.cancelled():
+                # retrieved, the error of a failed attempt is not logged as never retrieved
+                write.exception()
 
 
 def get_udemy_accss_token(cookies_filepath: str) -> str:
@@ -104,18 +1748,100 @@ def get_output_directory(output: Optional[str]) -> str:
 UdemyInfo = dict
 
 
-def get_udemy_course_info_by_course_name(course_name: str) -> Optional[UdemyInfo]:
+class SubscribedCourseIndex:
     """
-    :param course_name:
-    :return:
+    Index of the subscribed courses, keyed by published title and by id,
+    kept on disk when `file_path` is given.
+    Subscriptions come most recently accessed first, so a refresh stops at the first page
+    without any course the index does not know yet.
+    Looking up a course the index does not know reads pages until the course is found instead.
+    Every `ttl` seconds the index is rebuilt from all pages, dropping unsubscribed courses.
     """
-    response = requests.get(MY_COURSES_URL, headers=HEADERS)
-    udemy_course_infos = response.json()['results']
-    print(udemy_course_infos)
-    for udemy_course_info in udemy_course_infos:
-        if udemy_course_info['published_title'] == course_name:
-            return udemy_course_info
-    return None
+
+    def __init__(self, file_path: Optional[FilePath], ttl: float = SUBSCRIPTION_INDEX_TTL):
+        self.file_path = file_path
+        self.ttl = ttl
+        self.courses: Dict[int, UdemyInfo] = {}
+        self.by_title: Dict[str, UdemyInfo] = {}
+        # time of the last rebuild from all pages
+        self.built = 0.0
+        if file_path is not None:
+            try:
+                with open(file_path, encoding='utf-8') as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                pass
+            else:
+                self.built = index['built']
+                self.update(index['courses'])
+
+    def update(self, udemy_course_infos: Iterable[UdemyInfo]) -> None:
+        for udemy_course_info in udemy_course_infos:
+            self.courses[udemy_course_info['id']] = udemy_course_info
+            self.by_title[udemy_course_info['published_title']] = udemy_course_info
+
+    def find(self, course_name: str) -> Optional[UdemyInfo]:
+        """
+        :param course_name: published title or id of the course
+        :return:
+        """
+        if course_name.isdigit() and int(course_name) in self.courses:
+            return self.courses[int(course_name)]
+        return self.by_title.get(course_name)
+
+    @staticmethod
+    def matches(udemy_course_info: UdemyInfo, course_name: str) -> bool:
+        return udemy_course_info['published_title'] == course_name or \
+            str(udemy_course_info['id']) == course_name
+
+    async def refresh(self, session: aiohttp.ClientSession,
+                      course_name: Optional[str] = None) -> None:
+        """
+        :param session:
+        :param course_name: course looked up, pages are read until it is found or they run out,
+                            past pages without new courses
+        :return:
+        """
+        rebuild = time.time() - self.built >= self.ttl
+        if rebuild:
+            known = set()
+        else:
+            known = set(self.courses)
+        udemy_course_infos = []
+        url = MY_COURSES_URL
+        while url:
+            page = await fetch_json(session, url)
+            udemy_course_infos.extend(page['results'])
+            new_ids = {udemy_course_info['id'] for udemy_course_info in page['results']} - known
+            if not rebuild:
+                if course_name is None and not new_ids:
+                    break
+                if course_name is not None and any(self.matches(udemy_course_info, course_name)
+                                                   for udemy_course_info in page['results']):
+                    break
+            known |= new_ids
+            url = page.get('next')
+        if rebuild:
+            self.courses, self.by_title = {}, {}
+            self.built = time.time()
+        self.update(udemy_course_infos)
+        logging.info(f"{len(self.courses)} subscribed courses")
+        if self.file_path is not None:
+            os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+            await replace_file(self.file_path, json.dumps(
+                {'built': self.built, 'courses': list(self.courses.values())}))
+
+    async def lookup(self, session: aiohttp.ClientSession,
+                     course_name: str) -> Optional[UdemyInfo]:
+        """
+        find the course in the index, refreshing it for courses it does not know
+        :param session:
+        :param course_name:
+        :return:
+        """
+        if self.find(course_name) is None:
+            await self.refresh(session, course_name)
+        return self.find(course_name)
 
 
 def argument_processing():
@@ -126,10 +1852,14 @@ def argument_processing():
     description = 'A cross-platform python based utility to ' \
                   'download courses from udemy for personal offline use.'
     parser = argparse.ArgumentParser(description=description, conflict_handler='resolve')
-    parser.add_argument('course_name', help="Udemy course.", type=str)
+    parser.add_argument('course_names', metavar='course_name', nargs='*', type=str,
+                        help="Udemy course(s), downloaded together over one connection pool.")
     general = parser.add_argument_group("General")
     general.add_argument('-h', '--help', action='help', help="Shows the help.")
 
+    general.add_argument('--all', dest='all_courses', action='store_true',
+                         help="Download all subscribed courses.")
+
     authentication = parser.add_argument_group("Authentication")
     authentication.add_argument('-k', '--cookies-file', dest='cookies', type=str,
                                 help="Cookies file to authenticate with.", required=True)
@@ -150,140 +1880,637 @@ def argument_processing():
                          help="Download from specific position within chapter(s).")
     advance.add_argument('--lecture-end', dest='lecture_end', type=int,
                          help="Download till specific position within chapter(s).")
-    return parser.parse_args()
+
+    concurrency = parser.add_argument_group("Concurrency")
+    concurrency.add_argument('--max-streams', dest='max_streams', type=int, default=MAX_STREAMS,
+                             help=f"Maximum videos downloaded at once (default {MAX_STREAMS}).")
+    concurrency.add_argument('--max-chunks', dest='max_chunks', type=int, default=MAX_CHUNKS,
+                             help=f"Maximum chunk requests in flight (default {MAX_CHUNKS}).")
+    concurrency.add_argument('--max-small-assets', dest='max_small_assets', type=int,
+                             default=MAX_SMALL_ASSETS,
+                             help="Maximum captions, articles and external links fetched "
+                                  f"at once (default {MAX_SMALL_ASSETS}).")
+    concurrency.add_argument('--window', dest='window_size', type=int, default=WINDOW_SIZE,
+                             help=f"Chunks in flight per video (default {WINDOW_SIZE}).")
+    concurrency.add_argument('--chunk-size', dest='chunk_size', type=int, default=CHUNKSIZE,
+                             help=f"Initial chunk size in bytes (default {CHUNKSIZE}).")
+    concurrency.add_argument('--no-autotune', dest='autotune', action='store_false',
+                             help="Keep chunk size and per-host concurrency fixed.")
+    concurrency.add_argument('--uvloop', dest='uvloop', action='store_true',
+                             help="Run on the uvloop event loop, if it is installed.")
+
+    connection = parser.add_argument_group("Connection")
+    connection.add_argument('--max-connections', dest='max_connections', type=int,
+                            default=MAX_CONNECTIONS,
+                            help="Maximum open connections to video hosts "
+                                 f"(default {MAX_CONNECTIONS}).")
+    connection.add_argument('--max-api-connections', dest='max_api_connections', type=int,
+                            default=MAX_API_CONNECTIONS,
+                            help="Maximum open connections to the Udemy API "
+                                 f"(default {MAX_API_CONNECTIONS}).")
+    connection.add_argument('--max-connections-per-host', dest='max_connections_per_host',
+                            type=int, default=MAX_CONNECTIONS_PER_HOST,
+                            help="Maximum open connections to one host, 0 for no limit "
+                                 f"(default {MAX_CONNECTIONS_PER_HOST}).")
+    connection.add_argument('--keepalive-timeout', dest='keepalive_timeout', type=float,
+                            default=KEEPALIVE_TIMEOUT,
+                            help="Seconds an idle connection is kept open "
+                                 f"(default {KEEPALIVE_TIMEOUT}).")
+    connection.add_argument('--dns-cache-ttl', dest='dns_cache_ttl', type=int,
+                            default=DNS_CACHE_TTL,
+                            help=f"Seconds a resolved address is reused (default {DNS_CACHE_TTL}).")
+    connection.add_argument('--socket-buffer-size', dest='socket_buffer_size', type=int,
+                            default=SOCKET_BUFFER_SIZE,
+                            help="Bytes of socket send and receive buffers, "
+                                 "0 for system default (default 0).")
+    connection.add_argument('--connect-timeout', dest='connect_timeout', type=float,
+                            default=CONNECT_TIMEOUT,
+                            help=f"Seconds to wait for a connection (default {CONNECT_TIMEOUT}).")
+    connection.add_argument('--read-timeout', dest='read_timeout', type=float,
+                            default=READ_TIMEOUT,
+                            help="Seconds to wait for the next bytes of a response "
+                                 f"(default {READ_TIMEOUT}).")
+
+    bandwidth = parser.add_argument_group("Bandwidth")
+    bandwidth.add_argument('--limit-rate', dest='global_rate', type=parse_rate, default=0,
+                           help="Maximum bytes per second of all downloads, "
+                                "with an optional K, M or G suffix.")
+    bandwidth.add_argument('--limit-course-rate', dest='course_rate', type=parse_rate, default=0,
+                           help="Maximum bytes per second of each course.")
+    bandwidth.add_argument('--limit-stream-rate', dest='stream_rate', type=parse_rate, default=0,
+                           help="Maximum bytes per second of each video.")
+    bandwidth.add_argument('--rate-file', dest='rate_file', type=str,
+                           help="File with lines like `global 10M`, `course 5M` or `stream 1M`, "
+                                "reread whenever it changes to adjust limits while downloading.")
+
+    retries = parser.add_argument_group("Retry")
+    retries.add_argument('--retries', dest='retries', type=int, default=RETRY_ATTEMPTS,
+                         help=f"Retries of one request after a connection failure, timeout "
+                              f"or server error (default {RETRY_ATTEMPTS}).")
+    retries.add_argument('--retry-budget', dest='retry_budget', type=int, default=RETRY_BUDGET,
+                         help=f"Retries allowed for the whole run, each successful request "
+                              f"earns back {RETRY_BUDGET_REFILL} (default {RETRY_BUDGET}).")
+    retries.add_argument('--breaker-threshold', dest='breaker_threshold', type=int,
+                         default=BREAKER_THRESHOLD,
+                         help=f"Failures in a row after which requests to a video host pause "
+                              f"(default {BREAKER_THRESHOLD}).")
+    retries.add_argument('--breaker-cooldown', dest='breaker_cooldown', type=float,
+                         default=BREAKER_COOLDOWN,
+                         help=f"Seconds requests to a failing video host pause "
+                              f"(default {BREAKER_COOLDOWN}).")
+
+    rendition = parser.add_argument_group("Rendition")
+    rendition.add_argument('--max-resolution', dest='max_resolution', type=int,
+                           help="Download no rendition above this many lines, like 720.")
+    rendition.add_argument('--max-bitrate', dest='max_bitrate', type=parse_bitrate,
+                           help="Download no rendition above this many bits per second, "
+                                "with an optional K, M or G suffix, like 2.5M.")
+    rendition.add_argument('--byte-budget', dest='byte_budget', type=parse_size,
+                           help="Choose renditions so that the videos of each course fit "
+                                "in this many bytes, with an optional K, M or G suffix.")
+
+    observability = parser.add_argument_group("Observability")
+    observability.add_argument('--metrics-port', dest='metrics_port', type=int,
+                               help="Serve metrics in the Prometheus text format "
+                                    "at http://HOST:PORT/metrics while downloading.")
+    observability.add_argument('--metrics-host', dest='metrics_host', type=str,
+                               default=METRICS_HOST,
+                               help=f"Address the metrics endpoint listens on "
+                                    f"(default {METRICS_HOST}).")
+    observability.add_argument('--events', dest='events', type=str,
+                               help="Append stream and range lifecycle events to this file, "
+                                    "one JSON object per line.")
+    observability.add_argument('--trace', dest='trace', type=str,
+                               help="Record timed spans of requests, reads and disk writes "
+                                    "and save them to this file in the Chrome trace format.")
+
+    integrity = parser.add_argument_group("Integrity")
+    integrity.add_argument('--hash', dest='hash_algorithm', type=str,
+                           # shake digests need a length, which the sidecar format has no place for
+                           choices=sorted(algorithm for algorithm in hashlib.algorithms_guaranteed
+                                          if not algorithm.startswith('shake_')),
+                           help="Hash every video while it is downloaded and write the digest "
+                                "next to it, like VIDEO.sha256 for sha256.")
+
+    disk = parser.add_argument_group("Disk")
+    disk.add_argument('--writer-threads', dest='writer_threads', type=int, default=WRITER_THREADS,
+                      help=f"Threads writing downloaded bytes to disk (default {WRITER_THREADS}).")
+    disk.add_argument('--write-queue-size', dest='write_queue_size', type=parse_size,
+                      default=WRITE_QUEUE_SIZE,
+                      help="Bytes waiting for the writer threads before downloads pause, "
+                           "with an optional K, M or G suffix "
+                           f"(default {WRITE_QUEUE_SIZE // 1024 ** 2}M).")
+    disk.add_argument('--fsync', dest='fsync', choices=FSYNC_POLICIES, default='none',
+                      help="Sync downloaded bytes to disk after every chunk (range) "
+                           "or every video (file), or leave it to the OS (none, default).")
+
+    plan = parser.add_argument_group("Plan")
+    plan.add_argument('--plan', dest='plan', action='store_true',
+                      help="Print the bytes to download and an estimated duration, "
+                           "then exit without downloading.")
+    plan.add_argument('--plan-bandwidth', dest='plan_bandwidth', type=float,
+                      default=PLAN_BANDWIDTH,
+                      help=f"Download speed in MiB/s assumed by --plan (default {PLAN_BANDWIDTH}).")
+
+    cache = parser.add_argument_group("Cache")
+    cache.add_argument('--cache-dir', dest='cache_dir', type=str, default=CACHE_DIRECTORY,
+                       help="Directory of the curriculum cache and subscribed course index "
+                            f"(default {CACHE_DIRECTORY}).")
+    cache.add_argument('--cache-ttl', dest='cache_ttl', type=float, default=CURRICULUM_CACHE_TTL,
+                       help="Seconds a cached curriculum is used without revalidation "
+                            f"(default {CURRICULUM_CACHE_TTL}).")
+    cache.add_argument('--no-cache', dest='cache', action='store_false',
+                       help="Neither read nor write the curriculum cache "
+                            "and subscribed course index.")
+    args = parser.parse_args()
+    if not args.course_names and not args.all_courses:
+        parser.error("specify at least one course or --all")
+    return args
+
+
+def position_range(position: Optional[int], start: Optional[int],
+                   end: Optional[int]) -> Tuple[int, float]:
+    """
+    inclusive range of positions selected on the command line,
+    either the single `position` or from `start` to `end`
+    :param position:
+    :param start:
+    :param end:
+    :return:
+    """
+    if position is not None:
+        return position, position
+    return start if start is not None else 1, end if end is not None else math.inf
+
+
+def format_size(size: float) -> str:
+    if size < 1024:
+        return f"{size} B"
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'TiB'
+    return f"{size:.1f} {unit}"
+
+
+class PlannedLecture(NamedTuple):
+    lecture: 'UdemyLecture'
+    # bytes of the lecture video, 0 for lectures without video
+    size: int
+    # bytes not downloaded yet
+    remaining: int
+
+
+class HlsRendition(NamedTuple):
+    # vertical resolution, 0 when the master playlist does not tell
+    height: int
+    # peak bits per second
+    bandwidth: int
+    url: Url
+
+
+class HlsSegment(NamedTuple):
+    url: Url
+    # seconds
+    duration: float
+    # first and last byte of the segment in `url`, None for the whole resource
+    byte_range: Optional[Tuple[Start, Stop]] = None
+
+
+class EncryptedStreamError(Exception):
+    """
+    The segments of an HLS stream are encrypted and cannot be saved as they are.
+    """
+
+
+def parse_hls_attributes(line: str) -> Dict[str, str]:
+    """
+    :param line: tag like `#EXT-X-STREAM-INF:BANDWIDTH=1280000,RESOLUTION=1280x720`
+    :return: attributes with quotes removed
+    """
+    attributes = line.split(':', 1)[1] if ':' in line else ''
+    return {name: value.strip('"')
+            for name, value in re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', attributes)}
+
+
+def parse_master_playlist(text: str, url: Url) -> List[HlsRendition]:
+    """
+    :param text: master playlist
+    :param url: where the playlist came from, relative URIs are resolved against it
+    :return: renditions of the master playlist, none when `text` is a media playlist
+    """
+    renditions = []
+    attributes = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-STREAM-INF'):
+            attributes = parse_hls_attributes(line)
+        elif line and not line.startswith('#') and attributes is not None:
+            resolution = attributes.get('RESOLUTION', '')
+            height = int(resolution.split('x')[1]) if 'x' in resolution else 0
+            renditions.append(HlsRendition(height, int(attributes.get('BANDWIDTH', 0)),
+                                           urllib.parse.urljoin(url, line)))
+            attributes = None
+    return renditions
+
+
+def parse_byte_range(value: str, previous: Optional[Tuple[Start, Stop]]) -> Tuple[Start, Stop]:
+    """
+    :param value: byte range like `75232@0`, the offset may be left out
+    :param previous: sub-range of the previous segment, continued without an offset
+    :return: first and last byte of the sub-range
+    """
+    length, _, start = value.partition('@')
+    if start:
+        start = int(start)
+    elif previous is not None:
+        start = previous[1] + 1
+    else:
+        raise ValueError(f"byte range {value} without an offset or a previous sub-range")
+    return start, start + int(length) - 1
+
+
+def parse_media_playlist(text: str, url: Url) -> List[HlsSegment]:
+    """
+    :param text: media playlist
+    :param url: where the playlist came from, relative URIs are resolved against it
+    :return: segments in playback order, led by the initialization section if there is one
+    """
+    segments = []
+    duration = 0.0
+    byte_range = previous_range = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-KEY'):
+            if parse_hls_attributes(line).get('METHOD', 'NONE') != 'NONE':
+                raise EncryptedStreamError(f"{url}: encrypted segments")
+        elif line.startswith('#EXT-X-MAP'):
+            attributes = parse_hls_attributes(line)
+            # the offset of an initialization section is never left out
+            segments.append(HlsSegment(urllib.parse.urljoin(url, attributes['URI']), 0.0,
+                                       parse_byte_range(attributes['BYTERANGE'], None)
+                                       if 'BYTERANGE' in attributes else None))
+        elif line.startswith('#EXT-X-BYTERANGE'):
+            byte_range = parse_byte_range(line.split(':', 1)[1], previous_range)
+        elif line.startswith('#EXTINF'):
+            duration = float(line.split(':', 1)[1].split(',', 1)[0])
+        elif line and not line.startswith('#'):
+            segments.append(HlsSegment(urllib.parse.urljoin(url, line), duration, byte_range))
+            duration = 0.0
+            byte_range, previous_range = None, byte_range
+    return segments
+
+
+class RenditionPolicy:
+    """
+    Which rendition of a video to download.
+    Renditions above `max_resolution` lines or `max_bitrate` bits per second are left out
+    and the highest of the rest is taken, or the lowest rendition when none is left.
+    With a `byte_budget`, the renditions of a course are chosen together:
+    every video starts at its lowest rendition, then videos are upgraded
+    one step at a time, in turn, while the course still fits the budget.
+    """
+
+    def __init__(self, max_resolution: Optional[int] = None, max_bitrate: Optional[int] = None,
+                 byte_budget: Optional[int] = None):
+        self.max_resolution = max_resolution
+        self.max_bitrate = max_bitrate
+        self.byte_budget = byte_budget
+
+    @property
+    def needs_sizes(self) -> bool:
+        return self.max_bitrate is not None or self.byte_budget is not None
+
+    def allows(self, height: int, bitrate: int) -> bool:
+        """
+        :param height: vertical resolution, 0 when unknown
+        :param bitrate: bits per second, 0 when unknown
+        :return:
+        """
+        return (self.max_resolution is None or height <= self.max_resolution) and \
+               (self.max_bitrate is None or bitrate <= self.max_bitrate)
+
+    async def fit_budget(self, videos: List['UdemyAssetVideo'], session: aiohttp.ClientSession,
+                         scheduler: DownloadScheduler) -> int:
+        """
+        choose the rendition of every video in `videos` within the byte budget
+        :param videos:
+        :param session:
+        :param scheduler:
+        :return: bytes of the chosen renditions
+        """
+        choices = await asyncio.gather(*(video.renditions(session, scheduler)
+                                         for video in videos))
+        total = 0
+        pending = []
+        for video, streams in zip(videos, choices):
+            if len(streams) > 1:
+                pending.append((video, streams))
+                total += streams[0].size
+            else:
+                # no choice: finished, single rendition or HLS only
+                stream = await video.choose_stream(session, scheduler)
+                if stream is not None:
+                    total += (await stream.estimate(session, scheduler))[0]
+        if total > self.byte_budget:
+            logging.warning(f"Lowest renditions take {format_size(total)}, "
+                            f"over the budget of {format_size(self.byte_budget)}")
+        levels = [0] * len(pending)
+        upgraded = True
+        while upgraded:
+            upgraded = False
+            for i, (_, streams) in enumerate(pending):
+                if levels[i] + 1 < len(streams):
+                    extra = streams[levels[i] + 1].size - streams[levels[i]].size
+                    if total + extra <= self.byte_budget:
+                        levels[i] += 1
+                        total += extra
+                        upgraded = True
+        for (video, streams), level in zip(pending, levels):
+            video.selected = streams[level]
+        return total
 
 
 class UdemyCourse:
-    def __init__(self, id_: int, url: Url, published_title: str, output_directory: FilePath):
+    __slots__ = ('id_', 'curriculum_cache', 'policy', 'api', 'read_only', 'url',
+                 'published_title', 'chapters', 'directory', 'journal')
+
+    def __init__(self, id_: int, url: Url, published_title: str, output_directory: FilePath,
+                 curriculum_cache: Optional[CurriculumCache] = None,
+                 policy: Optional[RenditionPolicy] = None,
+                 api: Optional[aiohttp.ClientSession] = None, read_only: bool = False):
+        """
+        :param api: session of the API connection pool, for API requests of the lectures,
+                    which get the video CDN session
+        :param read_only: for plans, no directory is created and the journal is only read
+        """
         self.id_ = id_
+        self.curriculum_cache = curriculum_cache
+        self.policy = policy if policy is not None else RenditionPolicy()
+        self.api = api
+        self.read_only = read_only
         self.url = url
         self.published_title = published_title
         self.chapters = []
-        self.directory = os.path.join(output_directory, published_title)
+        self.directory = sys.intern(os.path.join(output_directory, published_title))
 
-        try:
-            os.mkdir(self.directory)
-        except FileExistsError:
-            pass
+        if not read_only:
+            try:
+                os.mkdir(self.directory)
+            except FileExistsError:
+                pass
+        self.journal = DownloadJournal(self.directory, read_only)
 
-        self.fill_course_chapters_and_lectures()
+    async def fetch_curriculum(self, session: aiohttp.ClientSession) -> AsyncIterator[dict]:
+        """
+        Chapter and lecture infos of the course in curriculum order, fetched page by page.
+        The next page is requested while the items of the current one are consumed.
+        With a curriculum cache, a fresh cached curriculum is used without any request
+        and pages are otherwise requested conditionally.
+        When the caller closes it early, the pages fetched so far are cached as a partial
+        curriculum, together with the cached pages after them.
+        :param session:
+        :return:
+        """
+        fetched, cached_pages = 0.0, []
+        if self.curriculum_cache is not None:
+            fetched, cached_pages = self.curriculum_cache.load(self.id_)
+            if cached_pages and self.curriculum_cache.is_fresh(fetched):
+                logging.info(f"Course {self.published_title}: using cached curriculum")
+                for page in cached_pages:
+                    for item in page['data']['results']:
+                        yield item
+                return
+        cached_pages = {page['url']: page for page in cached_pages}
+        pages = []
+        url = COURSE_URL.format(course_id=self.id_)
+        page = await fetch_cacheable_json(session, url, cached_pages.get(url))
+        next_page = None
+        try:
+            while True:
+                pages.append(page)
+                next_url = page['data'].get('next')
+                if next_url:
+                    next_page = asyncio.ensure_future(
+                        fetch_cacheable_json(session, next_url, cached_pages.get(next_url)))
+                for item in page['data']['results']:
+                    yield item
+                if next_page is None:
+                    break
+                page = await next_page
+                next_page = None
+        except GeneratorExit:
+            if self.curriculum_cache is not None:
+                fetched_urls = {page['url'] for page in pages}
+                await self.curriculum_cache.save(
+                    self.id_, pages + [page for url, page in cached_pages.items() if url not in fetched_urls],
+                    complete=False)
+            raise
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+        if self.curriculum_cache is not None:
+            await self.curriculum_cache.save(self.id_, pages)
+
+    def add_curriculum_item(self, item: dict) -> Optional['UdemyLecture']:
+        """
+        Add a chapter or a lecture to the course. Lectures belong to the last chapter added.
+        :param item: chapter or lecture info
+        :return: the lecture, or None for other items
+        """
+        class_ = item['_class']
+        if class_ == 'chapter':
+            self.chapters.append(UdemyChapter(item['id'], item['sort_order'], item['title'],
+                                              item['object_index'], self))
+        elif class_ == 'lecture':
+            return self.chapters[-1].add_lecture(item)
+        return None
+
+    async def load_lectures(self, session: aiohttp.ClientSession) -> AsyncIterator['UdemyLecture']:
+        """
+        Fill self.chapters from the curriculum, yielding every lecture as soon as it is parsed.
+        :param session:
+        :return:
+        """
+        items = self.fetch_curriculum(session)
+        try:
+            async for item in items:
+                udemy_lecture = self.add_curriculum_item(item)
+                if udemy_lecture is not None:
+                    yield udemy_lecture
+        finally:
+            # breaking out of `async for` leaves closing to the garbage collector
+            await items.aclose()
+
+    async def select_lectures(self, session: aiohttp.ClientSession, chapter: Optional[int] = None,
+                              lecture: Optional[int] = None, chapter_start: Optional[int] = None,
+                              chapter_end: Optional[int] = None,
+                              lecture_start: Optional[int] = None,
+                              lecture_end: Optional[int] = None) -> AsyncIterator['UdemyLecture']:
+        """
+        Lectures selected by chapter and lecture positions, which are numbered from 1,
+        yielded while the curriculum is loaded.
+        :return:
+        """
+        chapter_start, chapter_end = position_range(chapter, chapter_start, chapter_end)
+        lecture_start, lecture_end = position_range(lecture, lecture_start, lecture_end)
+        lectures = self.load_lectures(session)
+        try:
+            async for udemy_lecture in lectures:
+                chapter_position = len(self.chapters)
+                if chapter_position > chapter_end:
+                    break
+                if chapter_position >= chapter_start and \
+                        lecture_start <= len(udemy_lecture.chapter.lectures) <= lecture_end:
+                    yield udemy_lecture
+        finally:
+            # closed here so the curriculum read so far is cached
+            await lectures.aclose()
+
+    async def plan_lecture(self, session: aiohttp.ClientSession, scheduler: DownloadScheduler,
+                           udemy_lecture: 'UdemyLecture') -> 'PlannedLecture':
+        stream = await udemy_lecture.choose_stream(session, scheduler)
+        if stream is None:
+            return PlannedLecture(udemy_lecture, 0, 0)
+        size, remaining = await stream.estimate(session, scheduler)
+        return PlannedLecture(udemy_lecture, size, remaining)
+
+    async def fit_budget(self, session: aiohttp.ClientSession, scheduler: DownloadScheduler,
+                         lectures: AsyncIterator['UdemyLecture']) -> AsyncIterator['UdemyLecture']:
+        """
+        With a byte budget, all lectures are selected before any of them starts
+        and their renditions are chosen together.
+        :param session:
+        :param scheduler:
+        :param lectures:
+        :return: `lectures`
+        """
+        if self.policy.byte_budget is None:
+            return lectures
+        selected = [udemy_lecture async for udemy_lecture in lectures]
+        total = await self.policy.fit_budget(
+            [udemy_lecture.asset for udemy_lecture in selected
+             if isinstance(udemy_lecture.asset, UdemyAssetVideo)], session, scheduler)
+        logging.info(f"Course {self.published_title}: renditions of {format_size(total)} "
+                     f"chosen for a budget of {format_size(self.policy.byte_budget)}")
+        return iterate(selected)
+
+    async def plan(self, session: aiohttp.ClientSession, scheduler: DownloadScheduler,
+                   lectures: AsyncIterator['UdemyLecture']) -> List['PlannedLecture']:
+        """
+        Probe the size of every selected video concurrently
+        and order the lectures by the bytes they have left, largest first.
+        :param session:
+        :param scheduler:
+        :param lectures:
+        :return:
+        """
+        lectures = await self.fit_budget(session, scheduler, lectures)
+        plan = await asyncio.gather(*[self.plan_lecture(session, scheduler, udemy_lecture)
+                                      async for udemy_lecture in lectures])
+        return sorted(plan, key=lambda planned: (planned.remaining, planned.size), reverse=True)
 
-    def fill_course_chapters_and_lectures(self) -> None:
+    async def download(self, session: aiohttp.ClientSession, scheduler: DownloadScheduler,
+                       lectures: AsyncIterator['UdemyLecture']) -> None:
         """
-        Get udemy course chapters info and store them at self.chapters.
+        Every lecture is probed and handed to the scheduler as soon as it is parsed,
+        queued lectures with more bytes left start first.
+        :param session:
+        :param scheduler:
+        :param lectures:
         :return:
         """
-        response = requests.get(COURSE_URL.format(course_id=self.id_), headers=HEADERS)
-        results = response.json()
-        # courses chapters and lectures info
-        resources = results['results']
-        # the first element of each element is chapter info,
-        # and other elements of each element are lectures info,
-        # like this: [[chapter1, lecture1, lecture2], [chapter2, lecture3]]
-        chapters_and_lectures = []
-        for chapter_or_lecture in resources:
-            class_ = chapter_or_lecture['_class']
-            if class_ == 'chapter':
-                chapters_and_lectures.append([chapter_or_lecture])
-            elif class_ == 'lecture':
-                chapters_and_lectures[-1].append(chapter_or_lecture)
-        for chapter_and_lectures in chapters_and_lectures:
-            chapter = chapter_and_lectures[0]
-            lectures = chapter_and_lectures[1:]
-            print(chapter)
-            udemy_chapter = UdemyChapter(chapter['id'], chapter['sort_order'], chapter['title'],
-                                         chapter['object_index'], self, lectures)
-            self.chapters.append(udemy_chapter)
-
-    async def download(self, session: aiohttp.ClientSession, chapter: Optional[int] = None,
-                       lecture: Optional[int] = None, chapter_start: Optional[int] = None,
-                       chapter_end: Optional[int] = None, lecture_start: Optional[int] = None,
-                       lecture_end: Optional[int] = None, ) -> None:
         logging.info(f"start downloading course {self.published_title}")
-        if chapter is not None:
-            chapter_start = chapter - 1
-        elif chapter_start is None:
-            chapter_start = 0
-        else:
-            chapter_start = chapter_start - 1
-
-        if chapter is not None:
-            chapter_end = chapter - 1
-        elif chapter_end is None:
-            chapter_end = len(self.chapters) - 1
-        else:
-            chapter_end = chapter_end - 1
+        lectures = await self.fit_budget(session, scheduler, lectures)
 
-        await asyncio.gather(
-            *(chapter.download(session, lecture, lecture_start, lecture_end) for chapter in
-              self.chapters[chapter_start:chapter_end + 1]))
+        async def schedule(udemy_lecture: UdemyLecture) -> None:
+            try:
+                priority = -(await self.plan_lecture(session, scheduler, udemy_lecture)).remaining
+            except Exception:
+                # the lecture probes again when it starts
+                logging.exception("")
+                priority = 0
+            # lectures wait in the scheduler queue instead of all starting at once
+            await scheduler.submit(functools.partial(udemy_lecture.download, session, scheduler),
+                                   priority)
+
+        scheduled = []
+        try:
+            async for udemy_lecture in lectures:
+                scheduled.append(asyncio.ensure_future(schedule(udemy_lecture)))
+        finally:
+            await asyncio.gather(*scheduled, return_exceptions=True)
         logging.info(f"end downloading course {self.published_title}")
 
+    def print_plan(self, plan: List['PlannedLecture'], bandwidth: float) -> None:
+        """
+        :param plan:
+        :param bandwidth: assumed download speed in MiB/s
+        :return:
+        """
+        for planned in plan:
+            print(f"{format_size(planned.remaining):>10} of {format_size(planned.size):>10}  "
+                  f"{planned.lecture.chapter.chapter_index} {planned.lecture.lecture_index} "
+                  f"{planned.lecture.title}")
+        size = sum(planned.size for planned in plan)
+        remaining = sum(planned.remaining for planned in plan)
+        duration = datetime.timedelta(seconds=round(remaining / (bandwidth * 1024 * 1024)))
+        print(f"Course {self.published_title}: {len(plan)} lectures, {format_size(size)} in total, "
+              f"{format_size(remaining)} left, about {duration} at {bandwidth} MiB/s")
+
 
 class UdemyChapter:
-    def __init__(self, id_: int, sort_order, title: str, object_index, course: UdemyCourse,
-                 lectures: LectureInfoList):
+    __slots__ = ('id_', 'sort_order', 'title', 'chapter_index', 'lectures', 'course', 'directory')
+
+    def __init__(self, id_: int, sort_order, title: str, object_index, course: UdemyCourse):
         self.id_ = id_
         self.sort_order = sort_order
         self.title = title
         self.chapter_index = f'{object_index:02d}'
         self.lectures: List[UdemyLecture] = []
         self.course = course
-        self.directory = os.path.join(course.directory, self.chapter_index + " " + title)
-
-        try:
-            os.mkdir(self.directory)
-        except FileExistsError:
-            pass
-        for lecture in lectures:
-            udemy_lecture = UdemyLecture(lecture['id'], lecture['title'], lecture['asset'],
-                                         lecture['object_index'], lecture['supplementary_assets'],
-                                         self)
-            self.lectures.append(udemy_lecture)
-
-    async def download(self, session: aiohttp.ClientSession, lecture: Optional[int] = None,
-                       lecture_start: Optional[int] = None, lecture_end: Optional[int] = None):
-        logging.info(f"start downloading chapter {self.title}")
-        if lecture is not None:
-            lecture_start = lecture - 1
-        elif lecture_start is None:
-            lecture_start = 0
-        else:
-            lecture_start -= 1
+        # the one directory string shared by every lecture, asset and stream of the chapter
+        self.directory = sys.intern(os.path.join(course.directory,
+                                                 self.chapter_index + " " + title))
 
-        if lecture is not None:
-            lecture_end = lecture - 1
-        elif lecture_end is None:
-            lecture_end = len(self.lectures) - 1
-        else:
-            lecture_end -= 1
+        if not course.read_only:
+            try:
+                os.mkdir(self.directory)
+            except FileExistsError:
+                pass
 
-        await asyncio.gather(
-            *(lecture.download(session) for lecture in
-              self.lectures[lecture_start:lecture_end + 1]))
-        logging.info(f"end downloading chapter {self.title}")
+    def add_lecture(self, lecture: LectureInfo) -> 'UdemyLecture':
+        udemy_lecture = UdemyLecture(lecture['id'], lecture['title'], lecture['asset'],
+                                     lecture['object_index'], lecture['supplementary_assets'],
+                                     self)
+        self.lectures.append(udemy_lecture)
+        return udemy_lecture
 
 
 class UdemyLecture:
+    """
+    Lectures and their assets keep only what downloading needs, in slots.
+    Directories and file paths are derived from the chapter on access instead of stored.
+    """
+    __slots__ = ('id_', 'title', 'lecture_index', 'supplementary_assets', 'chapter', 'asset')
+
     def __init__(self, id_, title, asset: AssetInfo, object_index,
                  supplementary_assets: SupplementaryAssetInfoList, chapter: UdemyChapter):
         self.id_ = id_
         self.title = title
         self.lecture_index = f'{object_index:03d}'
-        self.supplementary_assets = supplementary_assets
         self.chapter = chapter
-        self.directory = chapter.directory
         self.asset: Optional[Union[UdemyAssetVideo, UdemyAssetArticle]] = None
         self.supplementary_assets = []
         asset_type = asset['asset_type']
         if asset_type == 'Video':
             self.asset = UdemyAssetVideo(asset['time_estimation'], asset['captions'],
                                          asset['filename'], asset['stream_urls'], asset['id'],
-                                         asset['body'], asset['slide_urls'], asset['download_urls'],
-                                         asset['external_url'], self)
+                                         self)
         elif asset_type == 'Article':
-            self.asset = UdemyAssetArticle(asset['id'], asset['body'], asset['time_estimation'],
-                                           self)
+            self.asset = UdemyAssetArticle(asset['id'], asset['time_estimation'], self)
 
         for supplementary_asset in supplementary_assets:
             asset_type = supplementary_asset['asset_type']
@@ -294,76 +2521,204 @@ class UdemyLecture:
                                           supplementary_asset['filename'],
                                           supplementary_asset['external_url'], self))
 
-    async def download(self, session: aiohttp.ClientSession):
-        if self.asset:
-            await self.asset.download(session)
+    @property
+    def directory(self) -> FilePath:
+        return self.chapter.directory
+
+    def file_path(self, suffix: str) -> FilePath:
+        """
+        :param suffix: appended to the index and title of the lecture, like '.mp4'
+        :return:
+        """
+        return os.path.join(self.chapter.directory, f'{self.lecture_index} {self.title}{suffix}')
+
+    async def choose_stream(self, session: aiohttp.ClientSession, scheduler: DownloadScheduler) \
+            -> Optional[Union['UdemyStream', 'UdemyHlsStream']]:
+        if isinstance(self.asset, UdemyAssetVideo):
+            return await self.asset.choose_stream(session, scheduler)
+        return None
 
-        for supplementary_asset in self.supplementary_assets:
-            supplementary_asset.download()
+    async def download(self, session: aiohttp.ClientSession, scheduler: DownloadScheduler):
+        assets = self.supplementary_assets + ([self.asset] if self.asset else [])
+        await gather_all(*(asset.download(session, scheduler) for asset in assets))
 
 
 class UdemyAssetEternalLink:
+    __slots__ = ('time_estimation', 'id_', 'filename', 'external_url', 'lecture')
+
     def __init__(self, time_estimation, id_, filename, external_url: Url, lecture: UdemyLecture):
         self.time_estimation = time_estimation
         self.id_ = id_
         self.filename = filename
         self.external_url = external_url
         self.lecture = lecture
-        self.directory = lecture.directory
 
-    def download(self):
+    @property
+    def directory(self) -> FilePath:
+        return self.lecture.chapter.directory
+
+    async def download(self, session: aiohttp.ClientSession, scheduler: DownloadScheduler):
         filename = self.lecture.lecture_index + " " + self.filename + '.txt'
-        with open(os.path.join(self.directory, filename), 'w') as f:
-            f.write(self.external_url)
+        file_path = os.path.join(self.directory, filename)
+        journal = self.lecture.chapter.course.journal
+        if journal.state(journal.key(file_path)) == DownloadJournal.DONE:
+            return
+        async with scheduler.small_asset_slots:
+            await write_file(file_path, self.external_url)
+        journal.finish(journal.key(file_path), None)
 
 
 class UdemyAssetVideo:
-    def __init__(self, time_estimation, captions, filename, streams: dict, id_, body, slide_urls,
-                 download_urls, external_urls, lecture: UdemyLecture):
+    __slots__ = ('time_estimation', 'filename', 'id_', 'lecture', 'captions', 'streams',
+                 'selected', 'refresh_lock')
+
+    def __init__(self, time_estimation, captions, filename, streams: dict, id_,
+                 lecture: UdemyLecture):
         self.time_estimation = time_estimation
-        # self.captions = captions
         self.filename = filename
-        # self.stream_urls = stream_urls
         self.id_ = id_
-        self.body = body
-        self.slide_urls = slide_urls
-        self.download_urls = download_urls
-        self.external_urls = external_urls
         self.lecture = lecture
-        self.directory = lecture.directory
-        self.captions = []
-
-        for caption in captions:
-            self.captions.append(UdemyCaption(caption['id'], caption['title'], caption['created'],
-                                              caption['file_name'], caption['status'],
-                                              caption['url'], caption['source'],
-                                              caption['locale_id'], caption['video_label'],
-                                              caption['asset_id'], self))
-        self.streams = []
-        for stream in streams['Video']:
-            self.streams.append(UdemyStream(stream['type'], stream['label'], stream['file'], self))
+        self.captions = tuple(UdemyCaption(caption['id'], caption['url'], caption['locale_id'],
+                                           self)
+                              for caption in captions)
+        self.streams = tuple((UdemyHlsStream if 'x-mpegURL' in stream['type'] else UdemyStream)(
+            stream['type'], stream['label'], stream['file'], self) for stream in streams['Video'])
+        self.selected: Optional[Union[UdemyStream, UdemyHlsStream]] = None
+        # created by the first refresh, most videos never need one
+        self.refresh_lock: Optional[asyncio.Lock] = None
+
+    async def download(self, session: aiohttp.ClientSession, scheduler: DownloadScheduler):
+        downloads = [caption.download(session, scheduler) for caption in self.captions]
+        stream = await self.choose_stream(session, scheduler)
+        if stream is None:
+            logging.warning(f"Video {self.lecture.title}: no downloadable stream")
+        else:
+            downloads.append(self.download_stream(stream, session, scheduler))
+        await gather_all(*downloads)
 
-    async def download(self, session: aiohttp.ClientSession):
-        for caption in self.captions:
-            caption.download()
-        # download video with max resolution
-        stream = max([stream for stream in self.streams if 'x-mpegURL' not in stream.type_],
-                     key=lambda stream_: int(stream_.label))
+    @staticmethod
+    async def download_stream(stream: Union['UdemyStream', 'UdemyHlsStream'],
+                              session: aiohttp.ClientSession, scheduler: DownloadScheduler):
+        """
+        download `stream`, accounted in the metrics and the event log
+        :param stream:
+        :param session:
+        :param scheduler:
+        :return:
+        """
+        started = time.time()
+        metrics.inc('udemy_dl_active_streams')
+        try:
+            await stream.download(session, scheduler)
+        except Exception as exc:
+            metrics.inc('udemy_dl_streams_total', outcome='failed')
+            events.emit('stream_failed', file=stream.file_path,
+                        error=f"{type(exc).__name__}: {exc}")
+            raise
+        else:
+            metrics.inc('udemy_dl_streams_total', outcome='done')
+            events.emit('stream_done', file=stream.file_path, seconds=time.time() - started)
+        finally:
+            metrics.inc('udemy_dl_active_streams', -1)
+            metrics.remove('udemy_dl_stream_remaining_bytes', file=stream.file_path)
+            metrics.remove('udemy_dl_stream_last_progress_seconds', file=stream.file_path)
+
+    async def renditions(self, session: aiohttp.ClientSession,
+                         scheduler: DownloadScheduler) -> List['UdemyStream']:
+        """
+        Progressive streams allowed by the rendition policy of the course, lowest first,
+        or the lowest stream alone when the policy allows none.
+        Streams are probed for their size when the policy needs it.
+        A finished video offers only the highest stream, which is not downloaded again.
+        :param session:
+        :param scheduler:
+        :return:
+        """
+        streams = sorted((stream for stream in self.streams if isinstance(stream, UdemyStream)),
+                         key=lambda stream_: int(stream_.label))
+        if not streams or streams[0].journal.state(streams[0].journal_path) == DownloadJournal.DONE:
+            return streams[-1:]
+        policy = self.lecture.chapter.course.policy
+        if policy.needs_sizes:
+            await gather_all(*(stream.probe_size(session, scheduler) for stream in streams))
+        allowed = [stream for stream in streams if policy.allows(int(stream.label), stream.bitrate)]
+        if not allowed:
+            logging.warning(f"Video {self.lecture.title}: no rendition within the limits, "
+                            f"taking the lowest")
+            return streams[:1]
+        return allowed
+
+    async def choose_stream(self, session: aiohttp.ClientSession, scheduler: DownloadScheduler) \
+            -> Optional[Union['UdemyStream', 'UdemyHlsStream']]:
+        """
+        :param session:
+        :param scheduler:
+        :return: the highest progressive stream allowed by the rendition policy,
+                 the HLS stream for lectures without a progressive one
+        """
+        if self.selected is None:
+            streams = await self.renditions(session, scheduler)
+            if streams:
+                self.selected = streams[-1]
+            else:
+                self.selected = next((stream for stream in self.streams
+                                      if isinstance(stream, UdemyHlsStream)), None)
+        return self.selected
 
-        await stream.download(session)
+    async def refresh_streams(self, expired_url: Url) -> None:
+        """
+        Fetch new signed URLs for the streams of this asset after `expired_url` was refused,
+        through the API session of the course.
+        Chunks refused at the same time wait for one refresh and then use its URLs.
+        :param expired_url:
+        :return:
+        """
+        if self.refresh_lock is None:
+            self.refresh_lock = asyncio.Lock()
+        async with self.refresh_lock:
+            if all(stream.file != expired_url for stream in self.streams):
+                # refreshed while waiting for the lock
+                return
+            course = self.lecture.chapter.course
+            url = LECTURE_URL.format(course_id=course.id_, lecture_id=self.lecture.id_)
+            lecture = await fetch_json(course.api, url)
+            files = {(stream['type'], stream['label']): stream['file']
+                     for stream in lecture['asset']['stream_urls']['Video']}
+            for stream in self.streams:
+                stream.file = files.get((stream.type_, stream.label), stream.file)
+            logging.info(f"Video {self.lecture.title}: stream URLs refreshed")
+            events.emit('urls_refreshed', lecture=self.lecture.title, expired=expired_url)
 
 
 class UdemyAssetArticle:
-    def __init__(self, id_, body, time_estimation, lecture: UdemyLecture):
+    """
+    The body of an article is fetched when the article is written, not kept with the curriculum.
+    """
+    __slots__ = ('time_estimation', 'id_', 'lecture')
+
+    def __init__(self, id_, time_estimation, lecture: UdemyLecture):
         self.time_estimation = time_estimation
         self.id_ = id_
-        self.body = body
         self.lecture = lecture
-        self.title = self.lecture.lecture_index + ' ' + self.lecture.title
-        self.file_name = self.title + '.html'
-        self.directory = self.lecture.directory
 
-    async def download(self, session):
+    @property
+    def title(self) -> str:
+        return self.lecture.lecture_index + ' ' + self.lecture.title
+
+    async def fetch_body(self) -> str:
+        course = self.lecture.chapter.course
+        url = ARTICLE_URL.format(course_id=course.id_, lecture_id=self.lecture.id_)
+        # an API request, kept off the video CDN pool the lecture downloads with
+        lecture = await fetch_json(course.api, url)
+        return lecture['asset']['body']
+
+    async def download(self, session: aiohttp.ClientSession, scheduler: DownloadScheduler):
+        file_path = self.lecture.file_path('.html')
+        journal = self.lecture.chapter.course.journal
+        if journal.state(journal.key(file_path)) == DownloadJournal.DONE:
+            return
+        async with scheduler.small_asset_slots:
+            body = await self.fetch_body()
         data = '''
                 <html>
                 <head>
@@ -386,184 +2741,658 @@ class UdemyAssetArticle:
                 crossorigin="anonymous"></script>
                 </body>
                 </html>
-                ''' % (self.title, self.body)
-        with open(os.path.join(self.directory, self.file_name), 'w') as f:
-            f.write(data)
+                ''' % (self.title, body)
+        async with scheduler.small_asset_slots:
+            await write_file(file_path, data)
+        journal.finish(journal.key(file_path), None)
 
 
 class UdemyStream:
+    __slots__ = ('type_', 'label', 'file', 'asset', 'size')
+
     def __init__(self, type_, label, file, asset: UdemyAssetVideo):
-        # content-type like this: 'video/mp4'
-        self.type_ = type_
-        self.label = label
+        # content-type like this: 'video/mp4', repeated by every stream of the course
+        self.type_ = sys.intern(type_)
+        self.label = sys.intern(label)
         self.file = file
         self.asset = asset
-        self.video_title = asset.lecture.title
-        self.directory = asset.directory
-        extension = self.type_.split('/')[-1]
-        self.file_path = os.path.join(self.directory, asset.lecture.lecture_index +
-                                      " " + asset.lecture.title + '.' + extension)
-        self.part_file_path = os.path.join(self.directory, asset.lecture.lecture_index +
-                                           " " + asset.lecture.title + '.' + extension + '.part')
+        # probed size of this rendition
+        self.size: Optional[int] = None
+
+    @property
+    def video_title(self) -> str:
+        return self.asset.lecture.title
+
+    @property
+    def file_path(self) -> FilePath:
+        return self.asset.lecture.file_path('.' + self.type_.split('/')[-1])
+
+    @property
+    def part_file_path(self) -> FilePath:
+        return self.file_path + '.part'
+
+    @property
+    def journal(self) -> DownloadJournal:
+        return self.asset.lecture.chapter.course.journal
 
-    @coroutine_retry(sleep=3)
-    async def download(self, session: aiohttp.ClientSession) -> None:
+    @property
+    def journal_path(self) -> str:
+        return self.journal.key(self.file_path)
+
+    @property
+    def bitrate(self) -> int:
+        """
+        :return: average bits per second from the probed size, 0 when unknown
+        """
+        if not self.size or not self.asset.time_estimation:
+            return 0
+        return int(self.size * 8 / self.asset.time_estimation)
+
+    async def download(self, session: aiohttp.ClientSession, scheduler: DownloadScheduler) -> None:
         """
+        All chunks are written straight to their offset in one preallocated `.part` file,
+        which is renamed to the video file once every chunk is in place.
         :param session:
+        :param scheduler:
         :return:
         """
         logging.info(f"Video {self.video_title}: start downloading")
         # video already downloaded
-        if os.path.exists(self.file_path):
+        if self.journal.state(self.journal_path) == DownloadJournal.DONE:
             return
-        headers = {'User-Agent': HEADERS.get('User-Agent')}
-        async with session.get(self.file, headers=headers) as resp:
-            content_length = resp.content_length
-        # In each iteration we download part of the video of size CHUNCKSIZE * PART_NUMBER.
-        part_file_path_list = [await self.download_part(i, start, end, session) for
-                               i, start, end in
-                               partition(1, content_length, CHUNKSIZE * PART_NUMBER)]
-        logging.info(
-            f'Video {self.video_title}: '
-            f'Downloading file parts completed. Now concatenate all file parts.')
-        with open(self.file_path, 'ab') as f:
-            for part_file_path in part_file_path_list:
-                with open(part_file_path, 'rb') as part_f:
-                    f.write(part_f.read())
-        logging.info('Concatenate all file parts completed. Now delete part files.')
-        # preserve temp files until the process of concatenating temp files
-        # into one single video file is completed,
-        # so that temp files are not deleted when the process of concatenating is interrupted.
-        for part_file_path in part_file_path_list:
-            os.remove(part_file_path)
+        content_length = await self.prepare(session, scheduler)
+        if self.journal.state(self.journal_path) == DownloadJournal.DONE:
+            return
+        if not os.path.exists(self.part_file_path):
+            # interrupted between renaming the `.part` file and updating the journal
+            if os.path.exists(self.file_path) and \
+                    os.stat(self.file_path).st_size == content_length:
+                self.journal.finish(self.journal_path, content_length)
+                return
+            self.journal.reset_ranges(self.journal_path)
+        completed = self.journal.completed_ranges(self.journal_path)
+        gaps = missing_ranges(completed, content_length)
+        remaining = sum(stop - start + 1 for start, stop in gaps)
+        events.emit('stream_start', file=self.file_path, url=self.file, size=content_length,
+                    remaining=remaining)
+        metrics.set('udemy_dl_stream_remaining_bytes', remaining, file=self.file_path)
+        # preallocating and hashing the ranges of an earlier run block, like writes
+        part_file = await scheduler.writer.run(PartFile, self.part_file_path, content_length,
+                                               scheduler.writer, scheduler.hash_algorithm,
+                                               completed)
+        try:
+            await self.download_chunks(part_file, gaps, session, scheduler)
+            with tracer.span('verify', 'disk', file=self.file_path):
+                missing = missing_ranges(self.journal.completed_ranges(self.journal_path),
+                                         content_length)
+                if missing:
+                    raise IntegrityError(f"{self.part_file_path}: bytes {missing} missing")
+                part_file.check_size()
+            if scheduler.writer.fsync == 'file':
+                await scheduler.writer.sync(part_file.fd)
+        finally:
+            await part_file.close()
+        logging.info(f'Video {self.video_title}: Downloading file chunks completed.')
+        async with tracer.span('finalize', 'disk', file=self.file_path):
+            if part_file.hasher is not None:
+                # sha256sum style, checked with `sha256sum -c`
+                await write_file(f'{self.file_path}.{scheduler.hash_algorithm}',
+                                 f'{part_file.hasher.hexdigest()}  '
+                                 f'{os.path.basename(self.file_path)}\n')
+            os.replace(self.part_file_path, self.file_path)
+            self.journal.finish(self.journal_path, content_length)
         logging.info(f"Video {self.video_title}: end downloading")
 
-    @coroutine_retry(sleep=3)
-    async def download_part(self, part_index: int, part_start: int, part_end: int,
-                            session: aiohttp.ClientSession) -> FilePath:
+    async def estimate(self, session: aiohttp.ClientSession,
+                       scheduler: DownloadScheduler) -> Tuple[int, int]:
+        """
+        Like `prepare`, without recording anything in the journal.
+        :param session:
+        :param scheduler:
+        :return: size of the video and bytes left to download
+        """
+        size = self.journal.size(self.journal_path)
+        if self.journal.state(self.journal_path) == DownloadJournal.DONE:
+            return size, 0
+        if await self.probe_size(session, scheduler) != size:
+            # not recorded yet, or recorded for another rendition whose ranges are dropped
+            size = self.size
+            if os.path.exists(self.file_path) and os.stat(self.file_path).st_size == size:
+                return size, 0
+            return size, size
+        return size, size - self.journal.completed_bytes(self.journal_path)
+
+    async def prepare(self, session: aiohttp.ClientSession, scheduler: DownloadScheduler) -> int:
         """
-        split part into chunks of size CHUNKSIZE and downloads chunks concurrently
-        :param part_index:
-        :param part_start:
-        :param part_end:
+        Size of the video, probed and recorded in the journal unless the video is done.
+        A size recorded for another rendition, after the policy changed between runs,
+        is replaced along with its ranges.
+        A complete file downloaded by a version without journal is recorded as done.
         :param session:
+        :param scheduler:
         :return:
         """
-        logging.info(f"Video {self.video_title} part {part_index + 1}: start downloading part")
-        part_file_path = self.part_file_path + str(part_index + 1)
-        if os.path.exists(part_file_path):
-            return part_file_path
-        chunk_file_path_list = await asyncio.gather(
-            *[self.download_chunk(part_index, i, chunk_start, chunk_end, session) for
-              i, chunk_start, chunk_end in partition(part_start, part_end, CHUNKSIZE)])
-        logging.info(
-            f"Video {self.video_title} part {part_index + 1}:  "
-            f"Downloading file chunks completed. Now concatenate all chunk files.")
-        with open(part_file_path, 'ab') as part_file:
-            for chunk_file_path in chunk_file_path_list:
-                with open(chunk_file_path, 'rb') as chunk_file:
-                    part_file.write(chunk_file.read())
-        logging.info(
-            f"Video {self.video_title} part {part_index + 1}: "
-            f"Concatenating all file chunks completed. Now delete chunk files")
-        for chunk_file_path in chunk_file_path_list:
-            os.remove(chunk_file_path)
-        logging.info(
-            f"Video {self.video_title} part {part_index + 1}: end downloading")
-
-        return part_file_path
-
-    @coroutine_retry(sleep=5)
-    async def download_chunk(self, part_index: int, chunk_index: int, chunk_start: int,
-                             chunk_end: int, session: aiohttp.ClientSession):
-        logging.info(
-            f"Video {self.video_title} part {part_index + 1} chunk {chunk_index + 1}: "
-            f"start downloading")
-        chunk_file_path = self.part_file_path + str(part_index + 1) + '.chunk' + str(
-            chunk_index + 1)
-        headers = {'User-Agent': HEADERS.get('User-Agent')}
-        if os.path.exists(chunk_file_path):
-            offset = os.stat(chunk_file_path).st_size
-            if offset >= (chunk_end - chunk_start + 1):
-                return chunk_file_path
-            # Request only part of an entity. Bytes are numbered from 0
-            # Range: bytes=500-999
-            # but chunk_start and chunk_end here are numbered from 1
-            headers['Range'] = f"bytes={chunk_start - 1 + offset}-{chunk_end - 1}"
-        else:
+        size = self.journal.size(self.journal_path)
+        if self.journal.state(self.journal_path) == DownloadJournal.DONE:
+            return size
+        if await self.probe_size(session, scheduler) != size:
+            size = self.size
+            if os.path.exists(self.file_path) and os.stat(self.file_path).st_size == size:
+                self.journal.finish(self.journal_path, size)
+            else:
+                self.journal.start(self.journal_path, size)
+        return size
 
-            headers['Range'] = f'bytes={chunk_start - 1}-{chunk_end - 1}'
-        with open(chunk_file_path, 'ab') as f:
-            async with session.get(self.file, headers=headers) as resp:
-                while True:
-                    chunk = await resp.content.read(CHUNKSIZE)
-                    if not chunk:
-                        break
-                    f.write(chunk)
+    async def probe_size(self, session: aiohttp.ClientSession,
+                         scheduler: DownloadScheduler) -> int:
+        if self.size is None:
+            self.size = await self.probe(session, scheduler)
+        return self.size
+
+    @retry
+    async def probe(self, session: aiohttp.ClientSession, scheduler: DownloadScheduler) -> int:
+        """
+        Size of the video from the `Content-Range` of a one byte range request.
+        :param session:
+        :param scheduler:
+        :return:
+        """
+        headers = {'User-Agent': HEADERS.get('User-Agent'), 'Range': 'bytes=0-0'}
+        breaker = scheduler.breaker(urllib.parse.urlsplit(self.file).hostname)
+        await breaker.wait()
+        async with scheduler.chunk_slots, tracer.span('probe', 'cdn', file=self.file_path):
+            url = self.file
+            try:
+                async with session.get(url, headers=headers) as resp:
+                    if resp.status in EXPIRED_URL_STATUSES:
+                        raise ExpiredUrlError(f"{url}: status {resp.status}")
+                    resp.raise_for_status()
+                    # Content-Range: bytes 0-0/1234
+                    content_range = resp.headers.get('Content-Range', '')
+                    if resp.status == 206 and '/' in content_range:
+                        size = int(content_range.rsplit('/', 1)[1])
+                    else:
+                        # range ignored, the response is the whole video
+                        size = resp.content_length
+            except ExpiredUrlError:
+                await self.asset.refresh_streams(url)
+                raise
+            except Exception as exc:
+                if is_retryable(exc):
+                    breaker.record_failure()
+                raise
+        breaker.record_success()
+        return size
+
+    async def download_chunks(self, part_file: PartFile, gaps: List[Tuple[Start, Stop]],
+                              session: aiohttp.ClientSession,
+                              scheduler: DownloadScheduler) -> None:
+        """
+        Keep a sliding window of `scheduler.window_size` chunks in flight,
+        the next chunk starts as soon as any chunk in the window completes.
+        Chunks are cut from `gaps` when they start, so each gets the chunk size
+        the host tuner settled on by then.
+        :param part_file:
+        :param gaps: byte ranges still missing from the `.part` file
+        :param session:
+        :param scheduler:
+        :return:
+        """
+        host = urllib.parse.urlsplit(self.file).hostname
+        tuner = scheduler.tuner(host)
+        buckets = scheduler.limiter.buckets(self.asset.lecture.chapter.course.id_)
+        if host not in scheduler.warm_hosts:
+            scheduler.warm_hosts.add(host)
+            await prewarm(session, self.file, min(len(gaps), tuner.slots.limit))
+        gaps = collections.deque(gaps)
+        pending = set()
+        chunk_index = 0
+        try:
+            while True:
+                while gaps and len(pending) < scheduler.window_size:
+                    gap_start, gap_stop = gaps.popleft()
+                    chunk_end = min(gap_stop, gap_start + tuner.chunk_size - 1)
+                    if chunk_end < gap_stop:
+                        gaps.appendleft((chunk_end + 1, gap_stop))
+                    pending.add(asyncio.ensure_future(self.download_chunk(
+                        part_file, chunk_index, gap_start, chunk_end, session, scheduler, tuner,
+                        buckets)))
+                    chunk_index += 1
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    @retry
+    async def download_chunk(self, part_file: PartFile, chunk_index: int, chunk_start: int,
+                             chunk_end: int, session: aiohttp.ClientSession,
+                             scheduler: DownloadScheduler,
+                             tuner: HostTuner, buckets: List[TokenBucket]) -> None:
+        logging.info(f"Video {self.video_title} chunk {chunk_index + 1}: start downloading")
+        async with HostRequest(scheduler, tuner, buckets, self.asset.refresh_streams, 'range',
+                               self.file_path, start=chunk_start, stop=chunk_end) as request:
+            events.emit('range_start', file=self.file_path, start=chunk_start, stop=chunk_end)
+            part_range = part_file.chunk(chunk_start)
+            try:
+                # read at request time, once a slot is free:
+                # a refresh after an expiry changes it for all chunks, also those waiting for a slot
+                await request.fetch(session, self.file, (chunk_start, chunk_end), part_file.size,
+                                    part_range.write)
+                await part_range.flush()
+            finally:
+                # a failed or cancelled attempt leaves no write behind
+                await part_range.drain()
+        metrics.inc('udemy_dl_stream_remaining_bytes', -request.size, file=self.file_path)
+        events.emit('range_done', file=self.file_path, start=chunk_start, stop=chunk_end,
+                    latency=request.latency, first_byte=request.first_byte,
+                    seconds=request.seconds)
+        self.journal.add_range(self.journal_path, chunk_start, chunk_end)
+
+        logging.info(f"Video {self.video_title} chunk {chunk_index + 1}: end downloading")
+
+
+class UdemyHlsStream:
+    """
+    HLS stream of a lecture without progressive download.
+    The highest rendition allowed by the rendition policy is picked from the master playlist,
+    its segments are fetched concurrently like the chunks of a UdemyStream
+    and appended to the `.part` file in playback order.
+    While downloading, the journal records the number of segments as size
+    and the byte range of every appended segment.
+    Playlist and segment URLs are signed like progressive ones: when they expire,
+    the streams of the asset are refreshed and the playlists loaded again.
+    """
+
+    __slots__ = ('type_', 'label', 'file', 'asset', 'rendition', 'segments', 'reload_lock')
+
+    def __init__(self, type_, label, file, asset: UdemyAssetVideo):
+        # content-type like this: 'application/x-mpegURL'
+        self.type_ = sys.intern(type_)
+        self.label = sys.intern(label)
+        self.file = file
+        self.asset = asset
+        self.rendition: Optional[HlsRendition] = None
+        self.segments: Optional[List[HlsSegment]] = None
+        # created by the first reload after an expiry
+        self.reload_lock: Optional[asyncio.Lock] = None
+
+    @property
+    def video_title(self) -> str:
+        return self.asset.lecture.title
+
+    @property
+    def file_path(self) -> FilePath:
+        return self.asset.lecture.file_path('.ts')
+
+    @property
+    def part_file_path(self) -> FilePath:
+        return self.file_path + '.part'
+
+    @property
+    def journal(self) -> DownloadJournal:
+        return self.asset.lecture.chapter.course.journal
+
+    @property
+    def journal_path(self) -> str:
+        return self.journal.key(self.file_path)
+
+    async def load_playlists(self, session: aiohttp.ClientSession) -> List[HlsSegment]:
+        """
+        :param session:
+        :return: segments of the picked rendition, fetched once
+        """
+        if self.segments is None:
+            self.segments = await self.fetch_playlists(session)
+        return self.segments
+
+    async def fetch_playlists(self, session: aiohttp.ClientSession) -> List[HlsSegment]:
+        """
+        Fetch the master and media playlists, on refreshed URLs after they expired.
+        :param session:
+        :return: segments of the picked rendition
+        """
+        import aiohttp
+        for refreshes in itertools.count():
+            master_url = self.file
+            try:
+                return await self.fetch_rendition(session, master_url)
+            except aiohttp.ClientResponseError as exc:
+                if exc.status not in EXPIRED_URL_STATUSES or refreshes == URL_REFRESHES:
+                    raise
+                await self.asset.refresh_streams(master_url)
+
+    async def fetch_rendition(self, session: aiohttp.ClientSession,
+                              url: Url) -> List[HlsSegment]:
+        text = await fetch_text(session, url)
+        renditions = parse_master_playlist(text, url)
+        if renditions:
+            policy = self.asset.lecture.chapter.course.policy
+            allowed = [rendition for rendition in renditions
+                       if policy.allows(rendition.height, rendition.bandwidth)]
+            self.rendition = max(allowed) if allowed else min(renditions)
+            url = self.rendition.url
+            text = await fetch_text(session, url)
+        return parse_media_playlist(text, url)
+
+    async def reload_playlists(self, session: aiohttp.ClientSession, expired_url: Url) -> None:
+        """
+        Load the playlists again after the segment URL `expired_url` was refused.
+        Segments refused at the same time wait for one reload and then use its URLs.
+        :param session:
+        :param expired_url:
+        :return:
+        """
+        if self.reload_lock is None:
+            self.reload_lock = asyncio.Lock()
+        async with self.reload_lock:
+            if all(segment.url != expired_url for segment in self.segments):
+                # reloaded while waiting for the lock
+                return
+            await self.asset.refresh_streams(self.file)
+            segments = await self.fetch_playlists(session)
+            if len(segments) != len(self.segments):
+                raise IntegrityError(f"{self.file}: {len(segments)} segments after reloading "
+                                     f"the playlists instead of {len(self.segments)}")
+            self.segments = segments
+            logging.info(f"Video {self.video_title}: playlists reloaded")
+
+    async def estimate(self, session: aiohttp.ClientSession,
+                       scheduler: DownloadScheduler) -> Tuple[int, int]:
+        """
+        Size estimated from the peak bandwidth and duration of the rendition.
+        :param session:
+        :param scheduler:
+        :return: size of the video and bytes left to download
+        """
+        if self.journal.state(self.journal_path) == DownloadJournal.DONE:
+            return self.journal.size(self.journal_path), 0
+        try:
+            segments = await self.load_playlists(session)
+        except EncryptedStreamError:
+            # skipped by download
+            return 0, 0
+        bandwidth = self.rendition.bandwidth if self.rendition is not None else 0
+        size = int(bandwidth * sum(segment.duration for segment in segments) / 8)
+        if not segments or self.journal.size(self.journal_path) != len(segments):
+            return size, size
+        appended = len(self.journal.completed_ranges(self.journal_path))
+        return size, size - size * appended // len(segments)
+
+    async def download(self, session: aiohttp.ClientSession, scheduler: DownloadScheduler) -> None:
+        logging.info(f"Video {self.video_title}: start downloading")
+        if self.journal.state(self.journal_path) == DownloadJournal.DONE:
+            return
+        try:
+            segments = await self.load_playlists(session)
+        except EncryptedStreamError as exc:
+            logging.error(f"Video {self.video_title}: {exc}, skipped")
+            return
+        if not os.path.exists(self.part_file_path):
+            self.journal.reset_ranges(self.journal_path)
+        # ranges of another playlist are dropped
+        self.journal.start(self.journal_path, len(segments))
+        completed = sorted(self.journal.completed_ranges(self.journal_path))
+        offset = completed[-1][1] + 1 if completed else 0
+        events.emit('stream_start', file=self.file_path, url=self.file, segments=len(segments),
+                    remaining=len(segments) - len(completed))
+        fd = os.open(self.part_file_path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0),
+                     0o666)
+        try:
+            # bytes of a segment appended after the last journal update
+            os.ftruncate(fd, offset)
+            hasher = None
+            if scheduler.hash_algorithm is not None:
+                hasher = StreamingHasher(scheduler.hash_algorithm, fd)
+                if offset:
+                    hasher.ahead.append((0, offset - 1))
+                    await scheduler.writer.submit(fd, 0, hasher.catch_up)
+            size = await self.download_segments(fd, hasher, segments, len(completed), offset,
+                                                session, scheduler)
+            if scheduler.writer.fsync == 'file':
+                await scheduler.writer.sync(fd)
+        finally:
+            await scheduler.writer.close_file(fd)
+        logging.info(f'Video {self.video_title}: Downloading segments completed.')
+        async with tracer.span('finalize', 'disk', file=self.file_path):
+            if hasher is not None:
+                await write_file(f'{self.file_path}.{scheduler.hash_algorithm}',
+                                 f'{hasher.hexdigest()}  {os.path.basename(self.file_path)}\n')
+            os.replace(self.part_file_path, self.file_path)
+            self.journal.finish(self.journal_path, size)
+        logging.info(f"Video {self.video_title}: end downloading")
+
+    async def download_segments(self, fd: int, hasher: Optional[StreamingHasher],
+                                segments: List[HlsSegment], first: int, offset: int,
+                                session: aiohttp.ClientSession,
+                                scheduler: DownloadScheduler) -> int:
+        """
+        Keep segments `first` and on in flight within a window of `scheduler.window_size`
+        past the next segment to append; finished segments wait in memory for their turn.
+        :param fd: file descriptor of the `.part` file
+        :param hasher:
+        :param segments:
+        :param first: index of the first segment not appended yet
+        :param offset: bytes already appended
+        :param session:
+        :param scheduler:
+        :return: size of the video
+        """
+        host = urllib.parse.urlsplit(segments[first].url if first < len(segments)
+                                     else self.file).hostname
+        tuner = scheduler.tuner(host)
+        buckets = scheduler.limiter.buckets(self.asset.lecture.chapter.course.id_)
+        pending: Dict[asyncio.Future, int] = {}
+        finished: Dict[int, List[bytes]] = {}
+        next_index = next_append = first
+        try:
+            while True:
+                while next_index < len(segments) and \
+                        next_index - next_append < scheduler.window_size:
+                    pending[asyncio.ensure_future(self.download_segment(
+                        next_index, session, scheduler, tuner, buckets))] = next_index
+                    next_index += 1
+                if not pending:
+                    break
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    finished[pending.pop(task)] = task.result()
+                while next_append in finished:
+                    buffers = finished.pop(next_append)
+                    size = sum(len(data) for data in buffers)
+                    async with tracer.span('append', 'disk', file=self.file_path,
+                                           index=next_append, size=size):
+                        await (await scheduler.writer.write(fd, buffers, offset, hasher))
+                        if scheduler.writer.fsync == 'range':
+                            await scheduler.writer.sync(fd)
+                    self.journal.add_range(self.journal_path, offset, offset + size - 1)
+                    events.emit('segment_done', file=self.file_path, index=next_append,
+                                start=offset, stop=offset + size - 1)
+                    offset += size
+                    next_append += 1
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        return offset
+
+    @retry
+    async def download_segment(self, index: int, session: aiohttp.ClientSession,
+                               scheduler: DownloadScheduler, tuner: HostTuner,
+                               buckets: List[TokenBucket]) -> List[bytes]:
+        """
+        :param index: of the segment, its URL is read at request time,
+                      a reload after an expiry changes it for all segments
+        :return: the reads of the segment as aiohttp received them, written without joining them
+        """
+        buffers: List[bytes] = []
 
-        logging.info(
-            f"Video {self.video_title} part {part_index + 1} chunk {chunk_index + 1}: "
-            f"end downloading")
-        return chunk_file_path
+        async def append(data: bytes) -> None:
+            buffers.append(data)
+
+        async with HostRequest(scheduler, tuner, buckets,
+                               functools.partial(self.reload_playlists, session), 'segment',
+                               self.file_path, index=index) as request:
+            # read once a slot is free, the URL may be reloaded while waiting for one
+            segment = self.segments[index]
+            await request.fetch(session, segment.url, segment.byte_range, None, append)
+        return buffers
 
 
 class UdemyCaption:
-    def __init__(self, id_, title, created, file_name, status, url, source, locale_id, video_label,
-                 asset_id, asset):
+    __slots__ = ('id_', 'url', 'locale_id', 'asset')
+
+    def __init__(self, id_, url, locale_id, asset: UdemyAssetVideo):
         self.id_ = id_
-        self.title = title
-        self.created = created
-        self.file_name = file_name
-        self.status = status
-        self.source = source
-        self.locale_id = locale_id
-        self.video_label = video_label
-        self.asset_id = asset_id
         self.url = url
+        self.locale_id = sys.intern(locale_id)
         self.asset = asset
-        self.directory = asset.directory
-        self.filename = self.asset.lecture.lecture_index + ' ' \
-                        + self.asset.lecture.title + '-' + locale_id.split('_')[0] + '.srt'
 
-    def download(self):
+    @property
+    def directory(self) -> FilePath:
+        return self.asset.lecture.chapter.directory
+
+    @property
+    def filename(self) -> str:
+        lecture = self.asset.lecture
+        return f"{lecture.lecture_index} {lecture.title}-{self.locale_id.split('_')[0]}.srt"
+
+    async def download(self, session: aiohttp.ClientSession, scheduler: DownloadScheduler):
+        import aiohttp
         file_path = os.path.join(self.directory, self.filename)
-        if os.path.exists(file_path):
+        journal = self.asset.lecture.chapter.course.journal
+        state = journal.state(journal.key(file_path))
+        # files without journal entry were downloaded by a version without journal
+        if state == DownloadJournal.DONE or state is None and os.path.exists(file_path):
             return
         headers = {'User-Agent': HEADERS.get('User-Agent')}
-        with open(file_path, 'wb') as f:
-
-            try:
-                response = requests.get(self.url, headers=headers)
-            except Exception:
-                pass
-            else:
-                f.write(response.content)
+        try:
+            async with scheduler.small_asset_slots:
+                async with session.get(self.url, headers=headers) as response:
+                    response.raise_for_status()
+                    data = await response.read()
+                await write_file(file_path, data)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # a missing caption is not worth failing the lecture for
+            logging.warning(f"Caption {self.filename}: download failed", exc_info=True)
+        else:
+            journal.finish(journal.key(file_path), len(data))
 
 
-async def entry() -> None:
+async def entry(args: argparse.Namespace) -> int:
     """
     download udemy course
-    :return:
+    :param args: parsed command line arguments
+    :return: exit status, 1 when any lecture failed
     """
     logging.info(f"Download starts")
-    args = argument_processing()
     access_token = get_udemy_accss_token(args.cookies)
     HEADERS.update({
         'Authorization': f'Bearer {access_token}',
         'X-Udemy-Authorization': f'Bearer {access_token}',
     })
-    udemy_course_info = get_udemy_course_info_by_course_name(args.course_name)
-    if udemy_course_info is None:
-        sys.exit("Cannot found specified udemy course.")
+    output_directory = get_output_directory(args.output)
+    if args.cache:
+        curriculum_cache = CurriculumCache(args.cache_dir, args.cache_ttl)
+        course_index = SubscribedCourseIndex(
+            os.path.join(curriculum_cache.directory, SUBSCRIPTION_INDEX_FILENAME))
     else:
-        output_directory = get_output_directory(args.output)
-        udemy_course = UdemyCourse(udemy_course_info['id'], udemy_course_info['url'],
-                                   udemy_course_info['published_title'], output_directory)
-        async with aiohttp.ClientSession() as session:
-            await udemy_course.download(session, args.chapter, args.lecture, args.chapter_start,
-                                        args.chapter_end, args.lecture_start, args.lecture_end)
+        curriculum_cache = None
+        course_index = SubscribedCourseIndex(None)
+    policy = RenditionPolicy(args.max_resolution, args.max_bitrate, args.byte_budget)
+    limiter = RateLimiter(args.global_rate, args.course_rate, args.stream_rate, args.rate_file)
+    scheduler = DownloadScheduler(args.max_streams, args.max_chunks, args.window_size,
+                                  args.chunk_size, args.autotune, args.max_small_assets, limiter,
+                                  args.hash_algorithm, args.breaker_threshold,
+                                  args.breaker_cooldown,
+                                  DiskWriter(args.writer_threads, args.write_queue_size,
+                                             args.fsync))
+    retry.configure(args.retries, args.retry_budget)
+    pools = ConnectionPools(args.max_connections, args.max_api_connections,
+                            args.max_connections_per_host, args.keepalive_timeout,
+                            args.dns_cache_ttl, args.socket_buffer_size, args.connect_timeout,
+                            args.read_timeout)
+
+    async def process(udemy_course: UdemyCourse) -> None:
+        lectures = udemy_course.select_lectures(pools.api, args.chapter, args.lecture,
+                                                args.chapter_start, args.chapter_end,
+                                                args.lecture_start, args.lecture_end)
+        try:
+            if args.plan:
+                plan = await udemy_course.plan(pools.cdn, scheduler, lectures)
+                udemy_course.print_plan(plan, args.plan_bandwidth)
+            else:
+                await udemy_course.download(pools.cdn, scheduler, lectures)
+        finally:
+            udemy_course.journal.close()
+
+    if args.events is not None:
+        events.open(args.events)
+    if args.trace is not None:
+        tracer.enable()
+    # all courses share one connection pool and one scheduler queue,
+    # so lectures of different courses interleave
+    missing_courses = 0
+    async with MetricsServer(args.metrics_host, args.metrics_port), pools, scheduler:
+        if args.all_courses:
+            await course_index.refresh(pools.api)
+            udemy_course_infos = list(course_index.courses.values())
+        else:
+            udemy_course_infos = []
+            for course_name in args.course_names:
+                udemy_course_info = await course_index.lookup(pools.api, course_name)
+                if udemy_course_info is None:
+                    logging.error(f"Cannot found udemy course {course_name}.")
+                    missing_courses += 1
+                else:
+                    udemy_course_infos.append(udemy_course_info)
+        if not udemy_course_infos:
+            sys.exit("Cannot found specified udemy course.")
+        udemy_courses = [UdemyCourse(udemy_course_info['id'], udemy_course_info['url'],
+                                     udemy_course_info['published_title'], output_directory,
+                                     curriculum_cache, policy, pools.api, args.plan)
+                         for udemy_course_info in udemy_course_infos]
+        try:
+            await gather_all(*(process(udemy_course) for udemy_course in udemy_courses))
+        finally:
+            if args.trace is not None:
+                tracer.save(args.trace)
+    events.close()
     logging.info(f"Download ends")
+    if missing_courses:
+        logging.error(f"{missing_courses} courses not found")
+    if scheduler.failures:
+        logging.error(f"{scheduler.failures} lectures failed, run again to resume them")
+    return 1 if missing_courses or scheduler.failures else 0
+
+
+def use_uvloop() -> None:
+    """
+    make uvloop the event loop of asyncio.run, keep the default loop when it is not installed
+    :return:
+    """
+    try:
+        import uvloop
+    except ImportError:
+        logging.warning("uvloop is not installed, running on the default event loop")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 
 def main():
-    asyncio.run(entry())
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(message)s',
+    )
+    args = argument_processing()
+    if args.uvloop:
+        use_uvloop()
+    sys.exit(asyncio.run(entry(args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Throughput benchmarks of async_udemy_dl against the local stand-in server.
+
+Every scenario starts benchmarks/standin.py with its injected faults and downloads
+its course once per concurrency and chunk size setting, reporting throughput,
+time to first byte, peak RSS and peak open file descriptors. With --baseline,
+a run slower or larger than a saved --json report by more than --tolerance fails.
+
+    python benchmarks/bench.py --max-chunks 8 32 --chunk-size 256K 1M --json report.json
+"""
+import argparse
+import itertools
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from typing import Dict, List, NamedTuple, Optional
+
+BENCHMARKS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+STANDIN = os.path.join(BENCHMARKS_DIRECTORY, 'standin.py')
+DOWNLOADER = os.path.join(os.path.dirname(BENCHMARKS_DIRECTORY), 'async_udemy_dl.py')
+COURSE = 'course-1'
+SAMPLE_INTERVAL = 0.05
+STARTUP_TIMEOUT = 10
+
+# stand-in arguments of every scenario
+SCENARIOS = {
+    'clean': [],
+    'slow': ['--latency', '0.05', '--bandwidth', '4M'],
+    'flaky': ['--reset-rate', '0.05', '--error-rate', '0.05'],
+    'expiring': ['--url-ttl', '1', '--bandwidth', '8M'],
+}
+
+
+class Result(NamedTuple):
+    scenario: str
+    max_chunks: int
+    chunk_size: int
+    seconds: float
+    downloaded_bytes: int
+    throughput: float
+    ttfb: Optional[float]
+    peak_rss: int
+    peak_fds: Optional[int]
+    # errors, resets and expired URLs injected by the stand-in
+    faults: int
+    returncode: int
+
+    @property
+    def key(self) -> str:
+        return f'{self.scenario}/{self.max_chunks}/{self.chunk_size}'
+
+
+def parse_size(size: str) -> int:
+    """
+    :param size: bytes, with an optional K, M or G suffix, like 500K or 2.5M
+    :return:
+    """
+    multiplier = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}.get(size[-1:].upper(), 1)
+    try:
+        return int(float(size[:-1] if multiplier != 1 else size) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {size}")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class StandInProcess:
+    """
+    The stand-in server in a subprocess, for the duration of a `with` block.
+    """
+
+    def __init__(self, arguments: List[str]):
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.arguments = arguments
+        self.process: Optional[subprocess.Popen] = None
+
+    def __enter__(self) -> 'StandInProcess':
+        self.process = subprocess.Popen([sys.executable, STANDIN, '--port', str(self.port),
+                                         *self.arguments])
+        deadline = time.time() + STARTUP_TIMEOUT
+        while True:
+            try:
+                self.stats()
+                return self
+            except OSError:
+                if self.process.poll() is not None or time.time() > deadline:
+                    self.__exit__(None, None, None)
+                    raise RuntimeError(f"stand-in server did not start: {self.arguments}")
+                time.sleep(0.1)
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.process.terminate()
+        self.process.wait()
+
+    def stats(self) -> dict:
+        with urllib.request.urlopen(self.url + '/_stats') as response:
+            return json.load(response)
+
+    def reset_stats(self) -> None:
+        urllib.request.urlopen(urllib.request.Request(self.url + '/_stats/reset',
+                                                      method='POST')).close()
+
+
+def count_fds(pid: int) -> Optional[int]:
+    try:
+        return len(os.listdir(f'/proc/{pid}/fd'))
+    except OSError:
+        # no procfs, or the process has just exited
+        return None
+
+
+def directory_size(directory: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(directory) for name in names)
+
+
+def first_byte_latency(events_path: str) -> Optional[float]:
+    """
+    :param events_path: event stream of a download
+    :return: median seconds from range request to first body byte, None without ranges
+    """
+    latencies = []
+    with open(events_path) as f:
+        for line in f:
+            event = json.loads(line)
+            if event['event'] == 'range_done':
+                # `latency` is only up to the response headers
+                latencies.append(event['first_byte'])
+    return statistics.median(latencies) if latencies else None
+
+
+def run_download(server: StandInProcess, scenario: str, max_chunks: int, chunk_size: int,
+                 extra_arguments: List[str]) -> Result:
+    """
+    Download the stand-in course once into a temporary directory
+    and sample the open file descriptors of the downloader while it runs.
+    :return:
+    """
+    with tempfile.TemporaryDirectory(prefix='async-udemy-dl-bench-') as directory:
+        cookies_path = os.path.join(directory, 'cookies.txt')
+        with open(cookies_path, 'w') as f:
+            f.write('access_token=bench')
+        output = os.path.join(directory, 'output')
+        os.mkdir(output)
+        events_path = os.path.join(directory, 'events.jsonl')
+        command = [sys.executable, DOWNLOADER, COURSE, '-k', cookies_path, '-o', output,
+                   '--no-cache', '--cache-dir', os.path.join(directory, 'cache'),
+                   '--max-chunks', str(max_chunks), '--chunk-size', str(chunk_size),
+                   '--events', events_path, *extra_arguments]
+        env = dict(os.environ, ASYNC_UDEMY_DL_URL=server.url)
+        server.reset_stats()
+        started = time.perf_counter()
+        process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL)
+        peak_fds = None
+        while True:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                break
+            fds = count_fds(process.pid)
+            if fds is not None:
+                peak_fds = max(peak_fds or 0, fds)
+            time.sleep(SAMPLE_INTERVAL)
+        seconds = time.perf_counter() - started
+        # reaped by wait4, keep Popen from waiting again
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+        downloaded_bytes = directory_size(output)
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        peak_rss = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        stats = server.stats()
+        faults = stats['errors'] + stats['resets'] + stats['expired']
+        return Result(scenario, max_chunks, chunk_size, seconds, downloaded_bytes,
+                      downloaded_bytes / seconds, first_byte_latency(events_path)
+                      if os.path.exists(events_path) else None,
+                      peak_rss, peak_fds, faults, process.returncode)
+
+
+def summarize(results: List[Result]) -> List[Result]:
+    """
+    :param results: repeated runs
+    :return: one result per setting, the median of its repeats
+    """
+    summary = []
+    for _, runs in itertools.groupby(results, key=lambda result: result.key):
+        runs = list(runs)
+        ttfbs = [run.ttfb for run in runs if run.ttfb is not None]
+        fds = [run.peak_fds for run in runs if run.peak_fds is not None]
+        summary.append(runs[0]._replace(
+            seconds=statistics.median(run.seconds for run in runs),
+            downloaded_bytes=min(run.downloaded_bytes for run in runs),
+            throughput=statistics.median(run.throughput for run in runs),
+            ttfb=statistics.median(ttfbs) if ttfbs else None,
+            peak_rss=max(run.peak_rss for run in runs),
+            peak_fds=max(fds) if fds else None,
+            faults=max(run.faults for run in runs),
+            returncode=max(runs, key=lambda run: abs(run.returncode)).returncode))
+    return summary
+
+
+def print_table(results: List[Result]) -> None:
+    print(f"{'scenario':<10} {'chunks':>6} {'chunk':>8} {'seconds':>8} {'MiB/s':>8} "
+          f"{'ttfb ms':>8} {'rss MiB':>8} {'fds':>5} {'faults':>6} {'exit':>4}")
+    for result in results:
+        ttfb = f'{result.ttfb * 1000:.1f}' if result.ttfb is not None else '-'
+        fds = result.peak_fds if result.peak_fds is not None else '-'
+        print(f"{result.scenario:<10} {result.max_chunks:>6} {result.chunk_size // 1024:>7}K "
+              f"{result.seconds:>8.2f} {result.throughput / 1024 ** 2:>8.1f} {ttfb:>8} "
+              f"{result.peak_rss / 1024 ** 2:>8.1f} {fds:>5} {result.faults:>6} "
+              f"{result.returncode:>4}")
+
+
+def regressions(results: List[Result], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """
+    :param results: summarized results of this run
+    :param baseline: summarized results of a saved report, by key
+    :param tolerance: fraction a result may be worse than its baseline
+    :return: descriptions of the results worse than their baseline
+    """
+    found = []
+    for result in results:
+        if result.returncode != 0:
+            found.append(f"{result.key}: download exited with {result.returncode}")
+        previous = baseline.get(result.key)
+        if previous is None:
+            continue
+        if result.throughput < previous['throughput'] * (1 - tolerance):
+            found.append(f"{result.key}: throughput {result.throughput / 1024 ** 2:.1f} MiB/s, "
+                         f"baseline {previous['throughput'] / 1024 ** 2:.1f} MiB/s")
+        if result.peak_rss > previous['peak_rss'] * (1 + tolerance):
+            found.append(f"{result.key}: peak RSS {result.peak_rss / 1024 ** 2:.1f} MiB, "
+                         f"baseline {previous['peak_rss'] / 1024 ** 2:.1f} MiB")
+    return found
+
+
+def argument_processing():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scenario', dest='scenarios', nargs='+', choices=list(SCENARIOS),
+                        default=list(SCENARIOS), help="Scenarios to run (default all).")
+    parser.add_argument('--max-chunks', dest='max_chunks', nargs='+', type=int, default=[8, 32],
+                        help="Values of the downloader --max-chunks to run (default 8 32).")
+    parser.add_argument('--chunk-size', dest='chunk_sizes', nargs='+', type=parse_size,
+                        default=[parse_size('256K'), parse_size('1M')],
+                        help="Values of the downloader --chunk-size to run (default 256K 1M).")
+    parser.add_argument('--autotune', action='store_true',
+                        help="Let the downloader tune chunk sizes and concurrency, "
+                             "off by default so every setting is measured as given.")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Runs of every setting, the median is reported (default 3).")
+    parser.add_argument('--video-size', dest='video_size', type=str, default='8M',
+                        help="Bytes of every video of the stand-in course (default 8M).")
+    parser.add_argument('--lectures', type=int, default=4,
+                        help="Video lectures per chapter of the stand-in course (default 4).")
+    parser.add_argument('--json', dest='json_path', type=str,
+                        help="Write the summarized results to this file.")
+    parser.add_argument('--baseline', type=str,
+                        help="Fail when a result is worse than in this --json report.")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Fraction a result may be worse than its baseline (default 0.2).")
+    return parser.parse_args()
+
+
+def main():
+    args = argument_processing()
+    extra_arguments = [] if args.autotune else ['--no-autotune']
+    course_arguments = ['--video-size', args.video_size, '--lectures', str(args.lectures)]
+    results = []
+    for scenario in args.scenarios:
+        with StandInProcess(SCENARIOS[scenario] + course_arguments) as server:
+            for max_chunks, chunk_size in itertools.product(args.max_chunks, args.chunk_sizes):
+                for _ in range(args.repeat):
+                    results.append(run_download(server, scenario, max_chunks, chunk_size,
+                                                extra_arguments))
+    results = summarize(results)
+    print_table(results)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump([{**result._asdict(), 'key': result.key} for result in results], f,
+                      indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {result['key']: result for result in json.load(f)}
+        found = regressions(results, baseline, args.tolerance)
+        for regression in found:
+            print(f"regression: {regression}", file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
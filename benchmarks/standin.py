@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Local stand-in for the Udemy API and video CDN, for benchmarks and tests without an account.
+
+It serves the subscribed courses, curriculum and lecture endpoints in the shapes
+async_udemy_dl requests, and range-capable videos with deterministic content.
+Latency, bandwidth caps, connection resets, 5xx errors and expiring signed URLs
+are injected on demand. Point async_udemy_dl at it with
+
+    ASYNC_UDEMY_DL_URL=http://127.0.0.1:8080 async-udemy-dl -k COOKIES_FILE course-1
+
+and any cookies file containing `access_token=x`.
+"""
+import argparse
+import asyncio
+import hashlib
+import random
+import time
+from typing import List, NamedTuple, Optional
+
+from aiohttp import web
+
+# bytes of video content repeated over and over, the content at a position depends on the video
+PATTERN = b''.join(hashlib.sha256(str(i).encode()).digest() for i in range(4096))
+WRITE_SIZE = 1024 * 64
+RENDITIONS = (1080, 720, 360)
+
+
+class StandInConfig(NamedTuple):
+    courses: int = 1
+    chapters: int = 2
+    lectures: int = 4
+    # article lectures per chapter, after the video lectures
+    articles: int = 0
+    # bytes of the highest rendition, lower renditions are smaller
+    video_size: int = 8 * 1024 * 1024
+    # seconds before the response headers of every video request
+    latency: float = 0.0
+    # bytes per second of each video response, 0 for no cap
+    bandwidth: int = 0
+    # probability that a video response is cut off halfway
+    reset_rate: float = 0.0
+    # probability that a video request is answered 503
+    error_rate: float = 0.0
+    # seconds a signed video URL is valid, 0 for URLs that never expire
+    url_ttl: float = 0.0
+
+
+def video_size(config: StandInConfig, rendition: int) -> int:
+    return config.video_size * rendition // RENDITIONS[0]
+
+
+def video_bytes(video_id: int, start: int, stop: int) -> bytes:
+    """
+    content of a video, deterministic so a downloaded copy can be checked
+    :param video_id:
+    :param start: first byte
+    :param stop: byte after the last one
+    :return:
+    """
+    offset = (start + video_id * 7919) % len(PATTERN)
+    repeats = (offset + stop - start) // len(PATTERN) + 1
+    return (PATTERN[offset:] + PATTERN * repeats)[:stop - start]
+
+
+class Stats:
+    """
+    What the stand-in served and injected since the last reset, served at /_stats.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.video_requests = 0
+        self.video_bytes = 0
+        self.api_requests = 0
+        self.resets = 0
+        self.errors = 0
+        self.expired = 0
+        self.first_byte: Optional[float] = None
+        self.last_byte: Optional[float] = None
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+
+class StandIn:
+    def __init__(self, config: StandInConfig):
+        self.config = config
+        self.stats = Stats()
+
+    def base_url(self, request: web.Request) -> str:
+        return f'{request.scheme}://{request.host}'
+
+    def video_url(self, request: web.Request, course_id: int, lecture_id: int,
+                  rendition: int) -> str:
+        url = f'{self.base_url(request)}/videos/{course_id}/{lecture_id}/{rendition}.mp4'
+        if self.config.url_ttl:
+            url += f'?expires={time.time() + self.config.url_ttl:.3f}'
+        return url
+
+    def stream_urls(self, request: web.Request, course_id: int, lecture_id: int) -> dict:
+        return {'Video': [{'type': 'video/mp4', 'label': str(rendition),
+                           'file': self.video_url(request, course_id, lecture_id, rendition)}
+                          for rendition in RENDITIONS]}
+
+    def curriculum(self, request: web.Request, course_id: int) -> List[dict]:
+        items = []
+        lecture_index = 1
+        for chapter_index in range(1, self.config.chapters + 1):
+            items.append({'_class': 'chapter', 'id': course_id * 1000 + chapter_index,
+                          'sort_order': chapter_index, 'title': f'Chapter {chapter_index}',
+                          'object_index': chapter_index})
+            for _ in range(self.config.lectures):
+                lecture_id = course_id * 1000 + lecture_index
+                items.append({
+                    '_class': 'lecture', 'id': lecture_id, 'title': f'Lecture {lecture_index}',
+                    'object_index': lecture_index, 'supplementary_assets': [],
+                    'asset': {
+                        'asset_type': 'Video', 'id': lecture_id, 'filename': '', 'body': '',
+                        'time_estimation': 600, 'slide_urls': [], 'download_urls': None,
+                        'external_url': None, 'captions': [],
+                        'stream_urls': self.stream_urls(request, course_id, lecture_id)}})
+                lecture_index += 1
+            for _ in range(self.config.articles):
+                lecture_id = course_id * 1000 + lecture_index
+                items.append({
+                    '_class': 'lecture', 'id': lecture_id, 'title': f'Lecture {lecture_index}',
+                    'object_index': lecture_index, 'supplementary_assets': [],
+                    'asset': {'asset_type': 'Article', 'id': lecture_id, 'time_estimation': 60}})
+                lecture_index += 1
+        return items
+
+    @staticmethod
+    def article_body(lecture_id: int) -> str:
+        return f'<p>Article of lecture {lecture_id}</p>'
+
+    @staticmethod
+    def page(request: web.Request, items: list) -> dict:
+        page = int(request.query.get('page', 1))
+        page_size = int(request.query.get('page_size', len(items) or 1))
+        next_url = None
+        if page * page_size < len(items):
+            next_url = str(request.url.update_query(page=str(page + 1)))
+        return {'count': len(items), 'next': next_url, 'previous': None,
+                'results': items[(page - 1) * page_size:page * page_size]}
+
+    async def subscribed_courses(self, request: web.Request) -> web.Response:
+        self.stats.api_requests += 1
+        courses = [{'id': course_id, 'url': f'/course-{course_id}/',
+                    'published_title': f'course-{course_id}'}
+                   for course_id in range(1, self.config.courses + 1)]
+        return web.json_response(self.page(request, courses))
+
+    async def course_curriculum(self, request: web.Request) -> web.Response:
+        self.stats.api_requests += 1
+        course_id = int(request.match_info['course_id'])
+        return web.json_response(self.page(request, self.curriculum(request, course_id)))
+
+    async def lecture(self, request: web.Request) -> web.Response:
+        self.stats.api_requests += 1
+        course_id = int(request.match_info['course_id'])
+        lecture_id = int(request.match_info['lecture_id'])
+        if request.query.get('fields[asset]') == 'body':
+            return web.json_response({'id': lecture_id,
+                                      'asset': {'body': self.article_body(lecture_id)}})
+        return web.json_response({'id': lecture_id, 'asset': {
+            'stream_urls': self.stream_urls(request, course_id, lecture_id)}})
+
+    async def video(self, request: web.Request) -> web.StreamResponse:
+        config = self.config
+        self.stats.video_requests += 1
+        lecture_id = int(request.match_info['lecture_id'])
+        rendition = int(request.match_info['rendition'])
+        video_id = lecture_id * 10 + RENDITIONS.index(rendition)
+        size = video_size(config, rendition)
+        if config.latency:
+            await asyncio.sleep(config.latency)
+        if 'expires' in request.query and float(request.query['expires']) < time.time():
+            self.stats.expired += 1
+            return web.Response(status=403)
+        if random.random() < config.error_rate:
+            self.stats.errors += 1
+            return web.Response(status=503)
+        start, stop = 0, size
+        status = 200
+        headers = {'Content-Type': 'video/mp4', 'Accept-Ranges': 'bytes'}
+        if 'Range' in request.headers:
+            http_range = request.http_range
+            start = http_range.start or 0
+            stop = min(size, http_range.stop if http_range.stop is not None else size)
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        headers['Content-Length'] = str(stop - start)
+        response = web.StreamResponse(status=status, headers=headers)
+        await response.prepare(request)
+        cut = start + (stop - start) // 2 if random.random() < config.reset_rate else None
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        sent = 0
+        for offset in range(start, stop, WRITE_SIZE):
+            if cut is not None and offset >= cut:
+                self.stats.resets += 1
+                request.transport.close()
+                return response
+            data = video_bytes(video_id, offset, min(stop, offset + WRITE_SIZE))
+            await response.write(data)
+            now = time.time()
+            if self.stats.first_byte is None:
+                self.stats.first_byte = now
+            self.stats.last_byte = now
+            self.stats.video_bytes += len(data)
+            sent += len(data)
+            if config.bandwidth:
+                # pace the response to `bandwidth` bytes per second
+                delay = started + sent / config.bandwidth - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        await response.write_eof()
+        return response
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats.as_dict())
+
+    async def reset_stats(self, request: web.Request) -> web.Response:
+        self.stats.reset()
+        return web.json_response({})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/api-2.0/users/me/subscribed-courses', self.subscribed_courses)
+        app.router.add_get('/api-2.0/courses/{course_id}/cached-subscriber-curriculum-items',
+                           self.course_curriculum)
+        app.router.add_get('/api-2.0/users/me/subscribed-courses/{course_id}/lectures/'
+                           '{lecture_id}', self.lecture)
+        app.router.add_get('/videos/{course_id}/{lecture_id}/{rendition}.mp4', self.video)
+        app.router.add_get('/_stats', self.get_stats)
+        app.router.add_post('/_stats/reset', self.reset_stats)
+        return app
+
+
+def parse_size(size: str) -> int:
+    """
+    :param size: bytes, with an optional K, M or G suffix, like 500K or 2.5M
+    :return:
+    """
+    multiplier = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}.get(size[-1:].upper(), 1)
+    try:
+        return int(float(size[:-1] if multiplier != 1 else size) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {size}")
+
+
+def add_config_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = StandInConfig()
+    parser.add_argument('--courses', type=int, default=defaults.courses,
+                        help=f"Subscribed courses (default {defaults.courses}).")
+    parser.add_argument('--chapters', type=int, default=defaults.chapters,
+                        help=f"Chapters per course (default {defaults.chapters}).")
+    parser.add_argument('--lectures', type=int, default=defaults.lectures,
+                        help=f"Video lectures per chapter (default {defaults.lectures}).")
+    parser.add_argument('--articles', type=int, default=defaults.articles,
+                        help=f"Article lectures per chapter (default {defaults.articles}).")
+    parser.add_argument('--video-size', type=parse_size, default=defaults.video_size,
+                        help=f"Bytes of the highest rendition of every video "
+                             f"(default {defaults.video_size}).")
+    parser.add_argument('--latency', type=float, default=defaults.latency,
+                        help="Seconds before the response headers of every video request.")
+    parser.add_argument('--bandwidth', type=parse_size, default=defaults.bandwidth,
+                        help="Bytes per second of each video response, 0 for no cap.")
+    parser.add_argument('--reset-rate', type=float, default=defaults.reset_rate,
+                        help="Probability that a video response is cut off halfway.")
+    parser.add_argument('--error-rate', type=float, default=defaults.error_rate,
+                        help="Probability that a video request is answered 503.")
+    parser.add_argument('--url-ttl', type=float, default=defaults.url_ttl,
+                        help="Seconds a signed video URL is valid, 0 for no expiry.")
+
+
+def config_from_args(args: argparse.Namespace) -> StandInConfig:
+    return StandInConfig(**{field: getattr(args, field) for field in StandInConfig._fields
+                            if hasattr(args, field)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on.")
+    parser.add_argument('--port', type=int, default=8080, help="Port to listen on.")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    web.run_app(StandIn(config_from_args(args)).app(), host=args.host, port=args.port,
+                access_log=None)
+
+
+if __name__ == '__main__':
+    main()
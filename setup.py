@@ -17,7 +17,8 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     py_modules=['async_udemy_dl'],
     python_requires='>=3.7',
-    install_requires=['requests', 'aiohttp'],
+    install_requires=['aiohttp'],
+    extras_require={'uvloop': ['uvloop']},
     entry_points={
         'console_scripts': [
             'async-udemy-dl = async_udemy_dl:main',
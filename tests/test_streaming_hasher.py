@@ -0,0 +1,57 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+from async_udemy_dl import StreamingHasher, pwrite
+
+
+class StreamingHasherTest(unittest.TestCase):
+    def setUp(self):
+        self.data = bytes(range(256)) * 64
+        fd, self.path = tempfile.mkstemp()
+        self.fd = fd
+        self.addCleanup(os.remove, self.path)
+        self.addCleanup(os.close, fd)
+
+    def write(self, hasher: StreamingHasher, start: int, stop: int) -> None:
+        pwrite(self.fd, self.data[start:stop], start)
+        hasher.update(start, self.data[start:stop])
+
+    def assertHashed(self, hasher: StreamingHasher) -> None:
+        self.assertEqual(hasher.position, len(self.data))
+        self.assertEqual(hasher.hexdigest(), hashlib.sha256(self.data).hexdigest())
+
+    def test_in_order(self):
+        hasher = StreamingHasher('sha256', self.fd)
+        for start in range(0, len(self.data), 1000):
+            self.write(hasher, start, start + 1000)
+        self.assertHashed(hasher)
+
+    def test_ahead(self):
+        hasher = StreamingHasher('sha256', self.fd)
+        self.write(hasher, 8000, len(self.data))
+        self.write(hasher, 3000, 8000)
+        self.write(hasher, 0, 3000)
+        self.assertHashed(hasher)
+
+    def test_retry_overlapping_hashed_position(self):
+        hasher = StreamingHasher('sha256', self.fd)
+        # a failed attempt wrote 0-5000, its retry writes runs of other sizes from 0 again
+        self.write(hasher, 0, 5000)
+        self.write(hasher, 0, 3000)
+        self.write(hasher, 3000, 7000)
+        self.write(hasher, 7000, len(self.data))
+        self.assertHashed(hasher)
+
+    def test_retry_overlapping_range_ahead(self):
+        hasher = StreamingHasher('sha256', self.fd)
+        self.write(hasher, 6000, 9000)
+        self.write(hasher, 5000, 7500)
+        self.write(hasher, 7500, len(self.data))
+        self.write(hasher, 0, 5000)
+        self.assertHashed(hasher)
+
+
+if __name__ == '__main__':
+    unittest.main()